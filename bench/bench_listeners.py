@@ -0,0 +1,278 @@
+"""on_message リスナーの負荷計測
+
+偽の discord.Message を大量に流し込み、LevelCog.on_message_level と
+GlobalCog.on_message_global の処理能力を測る。DBは fakemongo のインメモリ実装で、
+--latency で1往復あたりの待ち時間を指定できる。
+
+使い方 (リポジトリのルートで):
+    python -m bench.bench_listeners --messages 20000 --guilds 50 --users 2000 --latency 0.001
+    python -m bench.bench_listeners --cog global --global-channels 20 > bench_output.txt
+"""
+import argparse
+import asyncio
+import importlib
+import random
+import statistics
+import time
+import types
+
+from bench.fakemongo import FakeMotorClient
+from utils import percentile
+
+
+class FakeAsset:
+    def __init__(self, url):
+        self.url = url
+
+    def replace(self, **kwargs):
+        return self
+
+
+class FakeRole:
+    def __init__(self, role_id):
+        self.id = role_id
+        self.name = f"role{role_id}"
+        self.mention = f"<@&{role_id}>"
+
+    def __eq__(self, other):
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeUser:
+    def __init__(self, user_id, bot=False):
+        self.id = user_id
+        self.bot = bot
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.avatar = None
+        self.default_avatar = FakeAsset("https://cdn.discordapp.com/embed/avatars/0.png")
+        self.display_avatar = self.default_avatar
+        self.roles = [FakeRole(0)]
+
+    async def add_roles(self, *roles, **kwargs):
+        self.roles.extend(roles)
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+        self.roles = {}
+        self.members = {}
+
+    def get_role(self, role_id):
+        return self.roles.setdefault(role_id, FakeRole(role_id))
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+        self.name = f"channel{channel_id}"
+        self.sent = 0
+
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+
+
+class FakeMessage:
+    ids = iter(range(10 ** 6, 10 ** 12))
+
+    def __init__(self, guild, channel, author, content):
+        self.id = next(self.ids)
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.attachments = []
+        self.stickers = []
+        self.embeds = []
+        self.reference = None
+
+    async def reply(self, *args, **kwargs):
+        pass
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class FakeWebhook:
+    """bot.get_webhook が返すWebhookの代わり。送信ごとに --webhook-latency 秒待つ"""
+    latency = 0.0
+    sent = 0
+
+    def __init__(self, url):
+        self.url = url
+
+    async def send(self, *args, **kwargs):
+        FakeWebhook.sent += 1
+        if FakeWebhook.latency:
+            await asyncio.sleep(FakeWebhook.latency)
+        return types.SimpleNamespace(id=next(FakeMessage.ids))
+
+
+class FakeBucket:
+    """bot.webhook_bucket が返すレート制限の代わり。待たずに回数だけ数える"""
+    def __init__(self):
+        self.acquired = 0
+
+    async def acquire(self):
+        self.acquired += 1
+
+    def limited(self, retry_after):
+        pass
+
+
+class FakeBot:
+    """cogsが参照する commands.Bot の属性だけを持つ"""
+    def __init__(self, latency):
+        self.async_db = FakeMotorClient(latency)
+        self.main_db = self.async_db["Main"]
+        self.user = types.SimpleNamespace(id=1, name="bench", avatar=FakeAsset("https://example.invalid/bot.png"))
+        self.channels = {}
+        self.guilds = {}
+        self.cogs = {}
+        self.http_session = None
+        self.webhooks = {}
+        self.webhook_buckets = {}
+
+    async def wait_until_ready(self):
+        pass
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_guild(self, guild_id):
+        return self.guilds.get(guild_id)
+
+    def get_user(self, user_id):
+        return None
+
+    def get_cog(self, name):
+        return self.cogs.get(name)
+
+    def get_webhook(self, url):
+        if url not in self.webhooks:
+            self.webhooks[url] = FakeWebhook(url)
+        return self.webhooks[url]
+
+    def webhook_bucket(self, url):
+        if url not in self.webhook_buckets:
+            self.webhook_buckets[url] = FakeBucket()
+        return self.webhook_buckets[url]
+
+
+
+def make_world(bot, args):
+    guilds = []
+    for g in range(args.guilds):
+        guild = FakeGuild(10_000 + g)
+        guild.channel = FakeChannel(20_000 + g, guild)
+        bot.guilds[guild.id] = guild
+        bot.channels[guild.channel.id] = guild.channel
+        guilds.append(guild)
+    users = [FakeUser(100_000 + u) for u in range(args.users)]
+    return guilds, users
+
+
+def make_messages(guilds, users, args):
+    rng = random.Random(args.seed)
+    for _ in range(args.messages):
+        guild = rng.choice(guilds)
+        yield FakeMessage(guild, guild.channel, rng.choice(users), "hello " * rng.randint(1, 10))
+
+
+async def setup_level(bot, guilds, args):
+    level = importlib.import_module("cogs.level")
+    db = bot.async_db["Main"]
+    for guild in guilds:
+        await db.LevelingSetting.insert_one({"Guild": guild.id})
+    cog = level.LevelCog(bot)
+    return cog, cog.on_message_level
+
+
+async def setup_global(bot, guilds, args):
+    global_chat = importlib.import_module("cogs.global")
+    FakeWebhook.latency = args.webhook_latency
+    db = bot.async_db["Main"]
+    for guild in guilds[:args.global_channels]:
+        await db.GlobalChat.insert_one({"Guild": guild.id, "Channel": guild.channel.id, "WebHook": f"https://example.invalid/{guild.id}"})
+    cog = global_chat.GlobalCog(bot)
+    return cog, cog.on_message_global
+
+
+async def run(name, setup, args):
+    bot = FakeBot(args.latency)
+    guilds, users = make_world(bot, args)
+    cog, handler = await setup(bot, guilds, args)
+    bot.cogs[cog.qualified_name] = cog
+    if hasattr(cog, "cog_load"):
+        await cog.cog_load()
+    bot.async_db.calls.clear()
+    FakeWebhook.sent = 0
+
+    latencies = []
+    queue = asyncio.Queue()
+    for message in make_messages(guilds, users, args):
+        queue.put_nowait(message)
+
+    async def worker():
+        while not queue.empty():
+            message = queue.get_nowait()
+            start = time.perf_counter()
+            await handler(message)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    if hasattr(cog, "cog_unload"):
+        await cog.cog_unload()
+    calls = sum(bot.async_db.calls.values())
+    print(f"== {name} ==")
+    print(f"messages      : {args.messages} (guilds={args.guilds}, users={args.users}, concurrency={args.concurrency}, db latency={args.latency * 1000:.1f}ms)")
+    print(f"throughput    : {args.messages / elapsed:,.0f} msg/s ({elapsed:.2f}s)")
+    print(f"handler p50   : {percentile(latencies, 50) * 1000:.3f}ms")
+    print(f"handler p99   : {percentile(latencies, 99) * 1000:.3f}ms")
+    print(f"handler mean  : {statistics.fmean(latencies) * 1000:.3f}ms")
+    print(f"db calls/msg  : {calls / args.messages:.3f} (total {calls}, unload flush included)")
+    print("db calls      : " + ", ".join(f"{op}={n}" for op, n in sorted(bot.async_db.calls.items())))
+    if FakeWebhook.sent:
+        print(f"webhook sends : {FakeWebhook.sent}")
+    for name, values in getattr(cog, "cache_stats", dict)().items():
+        print(f"{name:<14}: " + ", ".join(f"{k}={v}" for k, v in values.items()))
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="on_message リスナーの負荷計測")
+    parser.add_argument("--cog", choices=["level", "global", "all"], default="all")
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32, help="同時に処理するメッセージ数")
+    parser.add_argument("--latency", type=float, default=0.0, help="DB 1往復の待ち時間(秒)")
+    parser.add_argument("--webhook-latency", type=float, default=0.0, help="Webhook送信1回の待ち時間(秒)")
+    parser.add_argument("--global-channels", type=int, default=5, help="グローバルチャットに参加しているチャンネル数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    async def bench():
+        if args.cog in ("level", "all"):
+            await run("LevelCog.on_message_level", setup_level, args)
+        if args.cog in ("global", "all"):
+            await run("GlobalCog.on_message_global", setup_global, args)
+
+    asyncio.run(bench())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+"""ベンチマーク用のインメモリMongoDB代替
+
+motorのAsyncIOMotorClientのうち、cogsが使う範囲だけを実装している。
+各操作の前に `latency` 秒待つので、DBの往復時間を擬似的に再現できる。
+"""
+import asyncio
+import copy
+import itertools
+import re
+from collections import Counter
+
+from pymongo import DeleteOne, InsertOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure
+
+
+def _get(doc, path):
+    cur = doc
+    for part in path.split("."):
+        if isinstance(cur, list):
+            values = [item.get(part) for item in cur if isinstance(item, dict)]
+            return values
+        if not isinstance(cur, dict) or part not in cur:
+            return None
+        cur = cur[part]
+    return cur
+
+
+def _compare(value, op, arg):
+    if op == "$in":
+        return value in arg or (isinstance(value, list) and any(v in arg for v in value))
+    if op == "$nin":
+        return value not in arg
+    if op == "$ne":
+        return value != arg
+    if op == "$exists":
+        return (value is not None) == bool(arg)
+    if op == "$regex":
+        return isinstance(value, str) and re.search(arg, value) is not None
+    if op == "$options":
+        return True
+    if value is None:
+        return False
+    if op == "$gt":
+        return value > arg
+    if op == "$gte":
+        return value >= arg
+    if op == "$lt":
+        return value < arg
+    if op == "$lte":
+        return value <= arg
+    if op == "$eq":
+        return value == arg
+    raise NotImplementedError(op)
+
+
+def _match(doc, flt):
+    for key, cond in (flt or {}).items():
+        if key == "$or":
+            if not any(_match(doc, sub) for sub in cond):
+                return False
+            continue
+        if key == "$and":
+            if not all(_match(doc, sub) for sub in cond):
+                return False
+            continue
+        if key == "$text":
+            words = cond["$search"].lower().split()
+            text = str(doc.get("Text", "")).lower()
+            if not any(w in text for w in words):
+                return False
+            continue
+        value = _get(doc, key)
+        if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+            if not all(_compare(value, op, arg) for op, arg in cond.items()):
+                return False
+        elif isinstance(value, list) and not isinstance(cond, list):
+            if cond not in value:
+                return False
+        elif value != cond:
+            return False
+    return True
+
+
+def _expr(doc, expr):
+    if isinstance(expr, str) and expr.startswith("$"):
+        return _get(doc, expr[1:])
+    if isinstance(expr, list):
+        return [_expr(doc, e) for e in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) == 1:
+        op, arg = next(iter(expr.items()))
+        if op == "$literal":
+            return arg
+        if op == "$add":
+            return sum(_expr(doc, a) or 0 for a in arg)
+        if op == "$subtract":
+            a, b = _expr(doc, arg)
+            return a - b
+        if op == "$ifNull":
+            value = _expr(doc, arg[0])
+            return _expr(doc, arg[1]) if value is None else value
+        if op == "$cond":
+            if isinstance(arg, dict):
+                arg = [arg["if"], arg["then"], arg["else"]]
+            return _expr(doc, arg[1]) if _expr(doc, arg[0]) else _expr(doc, arg[2])
+        if op in ("$gt", "$gte", "$lt", "$lte", "$eq", "$ne"):
+            a, b = _expr(doc, arg)
+            return _compare(a, op, b)
+        if op == "$max":
+            return max(_expr(doc, a) for a in arg)
+        if op == "$min":
+            return min(_expr(doc, a) for a in arg)
+    return {k: _expr(doc, v) for k, v in expr.items()}
+
+
+def _project(doc, projection):
+    if doc is None:
+        return None
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    if include:
+        doc = {k: v for k, v in doc.items() if k in include or (k == "_id" and projection.get("_id", True))}
+    else:
+        for k, v in projection.items():
+            if not v:
+                doc.pop(k, None)
+    return doc
+
+
+class FakeCursor:
+    def __init__(self, collection, flt, projection):
+        self.collection = collection
+        self.flt = flt
+        self.projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+        self._iter = None
+
+    def sort(self, key, direction=None):
+        if isinstance(key, list):
+            self._sort = key
+        else:
+            self._sort = [(key, direction or 1)]
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def _results(self):
+        docs = [d for d in self.collection._candidates(self.flt) if _match(d, self.flt)]
+        for key, direction in reversed(self._sort):
+            docs.sort(key=lambda d: (_get(d, key) is not None, _get(d, key)), reverse=direction < 0)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return [_project(d, self.projection) for d in docs]
+
+    async def to_list(self, length=None):
+        await self.collection.db.client.roundtrip("find")
+        docs = self._results()
+        return docs if length is None else docs[:length]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._iter is None:
+            await self.collection.db.client.roundtrip("find")
+            self._iter = iter(self._results())
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCollection:
+    _ids = itertools.count(1)
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        self.docs = {}  # _id: ドキュメント (挿入順)
+        self.indexes = {"_id_": {"key": [("_id", 1)]}}
+        # 一致検索を速くするための 項目 -> 値 -> {_id: ドキュメント}
+        self.lookup = {}
+
+    def _index(self, doc):
+        for k, v in doc.items():
+            try:
+                self.lookup.setdefault(k, {}).setdefault(v, {})[doc["_id"]] = doc
+            except TypeError:
+                continue
+
+    def _unindex(self, doc):
+        for k, v in doc.items():
+            try:
+                bucket = self.lookup.get(k, {}).get(v)
+            except TypeError:
+                continue
+            if bucket is not None:
+                bucket.pop(doc["_id"], None)
+
+    def _add(self, doc):
+        self.docs[doc["_id"]] = doc
+        self._index(doc)
+
+    def _remove(self, doc):
+        self._unindex(doc)
+        del self.docs[doc["_id"]]
+
+    def _candidates(self, flt):
+        best = None
+        for k, v in (flt or {}).items():
+            if k.startswith("$") or isinstance(v, (dict, list)):
+                continue
+            try:
+                bucket = self.lookup.get(k, {}).get(v, {})
+            except TypeError:
+                continue
+            if best is None or len(bucket) < len(best):
+                best = bucket
+        if best is None:
+            return list(self.docs.values())
+        return sorted(best.values(), key=lambda d: d["_id"])
+
+    async def _rt(self, op):
+        await self.db.client.roundtrip(op)
+
+    def _first(self, flt):
+        for doc in self._candidates(flt):
+            if _match(doc, flt):
+                return doc
+        return None
+
+    def _new_doc(self, flt):
+        doc = {"_id": next(self._ids)}
+        for k, v in (flt or {}).items():
+            if not k.startswith("$") and not isinstance(v, dict):
+                doc[k] = v
+        return doc
+
+    def _apply(self, doc, update, inserting):
+        if isinstance(update, list):
+            for stage in update:
+                (op, spec), = stage.items()
+                if op in ("$set", "$addFields"):
+                    values = {k: _expr(doc, v) for k, v in spec.items()}
+                    doc.update(values)
+                elif op == "$unset":
+                    for k in ([spec] if isinstance(spec, str) else spec):
+                        doc.pop(k, None)
+                else:
+                    raise NotImplementedError(op)
+            return
+        for op, spec in update.items():
+            if op == "$set":
+                doc.update(spec)
+            elif op == "$setOnInsert":
+                if inserting:
+                    doc.update(spec)
+            elif op == "$inc":
+                for k, v in spec.items():
+                    doc[k] = doc.get(k, 0) + v
+            elif op == "$max":
+                for k, v in spec.items():
+                    doc[k] = v if doc.get(k) is None else max(doc[k], v)
+            elif op == "$push":
+                for k, v in spec.items():
+                    if isinstance(v, dict) and "$each" in v:
+                        doc.setdefault(k, []).extend(v["$each"])
+                    else:
+                        doc.setdefault(k, []).append(v)
+            elif op == "$unset":
+                for k in spec:
+                    doc.pop(k, None)
+            else:
+                raise NotImplementedError(op)
+
+    def _update(self, flt, update, upsert):
+        doc = self._first(flt)
+        if doc is None:
+            if not upsert:
+                return None, None
+            doc = self._new_doc(flt)
+            self._apply(doc, update, True)
+            self._add(doc)
+            return None, doc
+        before = copy.deepcopy(doc)
+        self._unindex(doc)
+        self._apply(doc, update, False)
+        self._index(doc)
+        return before, doc
+
+    def _replace(self, flt, replacement, upsert):
+        doc = self._first(flt)
+        if doc is None:
+            if upsert:
+                new = {"_id": next(self._ids)}
+                new.update(replacement)
+                self._add(new)
+            return
+        self._unindex(doc)
+        _id = doc["_id"]
+        doc.clear()
+        doc["_id"] = _id
+        doc.update(replacement)
+        self._index(doc)
+
+    async def find_one(self, flt=None, projection=None, sort=None):
+        await self._rt("find_one")
+        if sort:
+            docs = await FakeCursor(self, flt, projection).sort(sort).limit(1).to_list(1)
+            return docs[0] if docs else None
+        return _project(self._first(flt), projection)
+
+    def find(self, flt=None, projection=None, sort=None, limit=0, skip=0):
+        cursor = FakeCursor(self, flt, projection)
+        if sort:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    async def count_documents(self, flt, limit=None, **kwargs):
+        await self._rt("count_documents")
+        n = sum(1 for d in self._candidates(flt) if _match(d, flt))
+        return min(n, limit) if limit else n
+
+    async def estimated_document_count(self):
+        await self._rt("count")
+        return len(self.docs)
+
+    async def insert_one(self, doc):
+        await self._rt("insert_one")
+        doc.setdefault("_id", next(self._ids))
+        self._add(copy.deepcopy(doc))
+
+    async def insert_many(self, docs, ordered=True):
+        await self._rt("insert_many")
+        for doc in docs:
+            doc.setdefault("_id", next(self._ids))
+            self._add(copy.deepcopy(doc))
+
+    async def replace_one(self, flt, replacement, upsert=False):
+        await self._rt("replace_one")
+        self._replace(flt, replacement, upsert)
+
+    async def update_one(self, flt, update, upsert=False):
+        await self._rt("update_one")
+        self._update(flt, update, upsert)
+
+    async def update_many(self, flt, update, upsert=False):
+        await self._rt("update_many")
+        for doc in [d for d in self._candidates(flt) if _match(d, flt)]:
+            self._unindex(doc)
+            self._apply(doc, update, False)
+            self._index(doc)
+
+    async def delete_one(self, flt):
+        await self._rt("delete_one")
+        doc = self._first(flt)
+        if doc is not None:
+            self._remove(doc)
+
+    async def delete_many(self, flt):
+        await self._rt("delete_many")
+        for doc in [d for d in self._candidates(flt) if _match(d, flt)]:
+            self._remove(doc)
+
+    async def find_one_and_update(self, flt, update, projection=None, upsert=False, return_document=ReturnDocument.BEFORE, **kwargs):
+        await self._rt("find_one_and_update")
+        before, after = self._update(flt, update, upsert)
+        doc = after if return_document == ReturnDocument.AFTER else before
+        return _project(doc, projection)
+
+    async def bulk_write(self, requests, ordered=True):
+        await self._rt("bulk_write")
+        for req in requests:
+            if isinstance(req, UpdateOne):
+                self._update(req._filter, req._doc, req._upsert)
+            elif isinstance(req, ReplaceOne):
+                self._replace(req._filter, req._doc, req._upsert)
+            elif isinstance(req, InsertOne):
+                doc = dict(req._doc)
+                doc.setdefault("_id", next(self._ids))
+                self._add(doc)
+            elif isinstance(req, DeleteOne):
+                doc = self._first(req._filter)
+                if doc is not None:
+                    self._remove(doc)
+            else:
+                raise NotImplementedError(type(req).__name__)
+
+    async def create_index(self, keys, **kwargs):
+        await self._rt("create_index")
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        name = kwargs.get("name") or "_".join(f"{k}_{v}" for k, v in keys)
+        self.indexes[name] = dict(kwargs, key=list(keys))
+        return name
+
+    async def create_indexes(self, models):
+        names = []
+        for model in models:
+            doc = dict(model.document)
+            keys = list(doc.pop("key").items())
+            names.append(await self.create_index(keys, **doc))
+        return names
+
+    async def index_information(self):
+        await self._rt("index_information")
+        return copy.deepcopy(self.indexes)
+
+    def watch(self, *args, **kwargs):
+        raise OperationFailure("The $changeStream stage is only supported on replica sets")
+
+
+class FakeDatabase:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(self, name)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def watch(self, *args, **kwargs):
+        raise OperationFailure("The $changeStream stage is only supported on replica sets")
+
+
+class FakeMotorClient:
+    """AsyncIOMotorClientの代わりに使うクライアント"""
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.databases = {}
+
+    async def roundtrip(self, op):
+        self.calls[op] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(0)
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = FakeDatabase(self, name)
+        return self.databases[name]
+
+    def close(self):
+        pass
@@ -1,15 +1,271 @@
 from discord.ext import commands
 import discord
 import asyncio
-import aiohttp
-from discord import Webhook
 import time
+import os
+import tempfile
+import aiohttp
+import datetime
+from collections import Counter, OrderedDict, deque
+from utils import percentile
+
+GLOBAL_FANOUT_CONCURRENCY = 50  # 同時に送信するWebhookの最大数
+GLOBAL_METRICS_SAMPLES = 2000   # 配信時間の統計に使う直近の件数
+GLOBAL_USER_RATE = 1 / 3       # ユーザーごとに1秒あたり回復する送信回数
+GLOBAL_USER_BURST = 3           # ユーザーごとに連続で送れる回数
+GLOBAL_GUILD_RATE = 1.0         # サーバーごとに1秒あたり回復する送信回数
+GLOBAL_GUILD_BURST = 10         # サーバーごとに連続で送れる回数
+GLOBAL_LIMITER_MAX_ENTRIES = 100000  # レート制限で覚えておくユーザー・サーバーの最大数
+GLOBAL_THROTTLED_REACTION = "⏳"
+GLOBAL_ATTACHMENT_MAX_FILES = 4  # 1メッセージで転送する添付ファイルの最大数
+GLOBAL_ATTACHMENT_MAX_BYTES = 8 * 1024 * 1024  # 転送する添付ファイル1つの最大サイズ
+GLOBAL_ATTACHMENT_TOTAL_BYTES = 10 * 1024 * 1024  # 1メッセージで転送する添付ファイルの合計サイズ上限 (配信先サーバーの上限が小さければそちらに合わせる)
+GLOBAL_ATTACHMENT_TYPES = ("image/", "video/", "audio/", "text/plain")  # 転送するファイルの種類
+GLOBAL_ATTACHMENT_CHUNK = 64 * 1024  # ダウンロードを読み込む単位
+GLOBAL_MESSAGE_TTL = 60 * 60 * 24 * 7  # 転送先のメッセージIDを覚えておく秒数 (TTLインデックスで消える)
+GLOBAL_MESSAGE_CACHE_SIZE = 20000  # メモリに置いておく転送元メッセージの数
+# 複数プロセスで動かす場合はTrueにするとchange streamで参加・退出を受け取る (レプリカセットが必要)
+GLOBAL_CHAT_CHANGE_STREAM = False
+
+class TokenBucketLimiter:
+    """キーごとのトークンバケット。満タンまで回復したキーは覚えておく必要がないので捨てる"""
+    def __init__(self, rate: float, burst: int, max_entries: int = GLOBAL_LIMITER_MAX_ENTRIES):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        self.idle = burst / rate  # この秒数使われなければ満タンに戻っている
+        self.buckets = OrderedDict()  # key: [トークン, 最後に使った時刻, 制限を通知済みか] 使った順
+        self.throttled = 0
+        self.evictions = 0
+
+    def tokens(self, key, now: float):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.burst
+        return min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+    def consume(self, key, now: float):
+        self.buckets[key] = [self.tokens(key, now) - 1, now, False]
+        self.buckets.move_to_end(key)
+        self.evict(now)
+
+    def throttle(self, key):
+        # 制限中に最初に送られたメッセージでだけTrueを返す (リアクションを付けすぎないように)
+        self.throttled += 1
+        bucket = self.buckets.get(key)
+        if bucket is None or bucket[2]:
+            return False
+        bucket[2] = True
+        return True
+
+    def evict(self, now: float):
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if now - bucket[1] < self.idle and len(self.buckets) <= self.max_entries:
+                break
+            del self.buckets[key]
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "entries": len(self.buckets),
+            "max_entries": self.max_entries,
+            "throttled": self.throttled,
+            "evictions": self.evictions,
+        }
+
+class RelayCache:
+    """転送元メッセージID -> 転送先 (チャンネル, メッセージID) の対応のLRU。転送先のIDからも引ける"""
+    def __init__(self, maxsize: int = GLOBAL_MESSAGE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.sources = OrderedDict()  # 転送元のメッセージID: GlobalChatMessageのドキュメント
+        self.copies = {}  # 転送先のメッセージID: 転送元のメッセージID
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, message_id: int):
+        relay = self.sources.get(message_id)
+        if relay is None:
+            source_id = self.copies.get(message_id)
+            relay = self.sources.get(source_id) if source_id is not None else None
+        if relay is None:
+            self.misses += 1
+            return None
+        self.sources.move_to_end(relay["Source"])
+        self.hits += 1
+        return relay
+
+    def is_copy(self, message_id: int):
+        return message_id in self.copies
+
+    def put(self, relay: dict):
+        self.remove(relay["Source"])
+        self.sources[relay["Source"]] = relay
+        for copy in relay["Copies"]:
+            self.copies[copy["Message"]] = relay["Source"]
+        while len(self.sources) > self.maxsize:
+            self.remove(next(iter(self.sources)))
+
+    def remove(self, source_id: int):
+        relay = self.sources.pop(source_id, None)
+        if relay is None:
+            return
+        for copy in relay["Copies"]:
+            self.copies.pop(copy["Message"], None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.sources),
+            "copies": len(self.copies),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+class GlobalChatRegistry:
+    """グローバルチャットに参加しているチャンネルとWebhookの一覧 (起動時にDBから読み込む)"""
+    def __init__(self):
+        self.channels = {}  # channel_id: GlobalChatのドキュメント
+        self.ids = {}  # _id: channel_id (change streamの削除はdocumentKeyしか分からない)
+        self.targets = []  # 配信先の一覧 (変更があったときだけ作り直す)
+        self.loaded = False
+
+    def __contains__(self, channel_id: int):
+        return channel_id in self.channels
+
+    def __len__(self):
+        return len(self.channels)
+
+    def load(self, docs: list):
+        self.channels = {}
+        self.ids = {}
+        for doc in docs:
+            self.put(doc, rebuild=False)
+        self.rebuild()
+        self.loaded = True
+
+    def rebuild(self):
+        self.targets = list(self.channels.values())
+
+    def put(self, doc: dict, rebuild: bool = True):
+        doc = {"Guild": doc.get("Guild"), "Channel": doc["Channel"], "WebHook": doc.get("WebHook"), "_id": doc.get("_id")}
+        self.channels[doc["Channel"]] = doc
+        if doc["_id"] is not None:
+            self.ids[doc["_id"]] = doc["Channel"]
+        if rebuild:
+            self.rebuild()
 
-user_last_message_timegc = {}
+    def remove(self, channel_id: int):
+        doc = self.channels.pop(channel_id, None)
+        if doc is None:
+            return
+        self.ids.pop(doc["_id"], None)
+        self.rebuild()
+
+    def remove_id(self, _id):
+        channel_id = self.ids.pop(_id, None)
+        if channel_id is not None:
+            self.remove(channel_id)
 
 class GlobalCog(commands.Cog):
+    mongo_indexes = {
+        "GlobalChat": [
+            ([("Channel", 1)], {"unique": True}),
+            ([("Guild", 1), ("Channel", 1)], {}),
+        ],
+        "GlobalChatMessage": [
+            ([("Source", 1)], {"unique": True}),
+            ([("Copies.Message", 1)], {}),
+            ([("Time", 1)], {"expireAfterSeconds": GLOBAL_MESSAGE_TTL}),
+        ],
+    }
+    mongo_queries = {
+        "GlobalChat": [("Channel",), ("Guild", "Channel")],
+        "GlobalChatMessage": [("Source",), ("Copies.Message",)],
+    }
+
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.fanout_semaphore = asyncio.Semaphore(GLOBAL_FANOUT_CONCURRENCY)
+        self.send_times = deque(maxlen=GLOBAL_METRICS_SAMPLES)      # Webhook送信1回にかかった秒数
+        self.delivery_times = deque(maxlen=GLOBAL_METRICS_SAMPLES)  # 投稿から各チャンネルに届くまでの秒数
+        self.fanout_times = deque(maxlen=GLOBAL_METRICS_SAMPLES)    # 全チャンネルに届くまでの秒数
+        self.fanout_stats = Counter()
+        self.registry = GlobalChatRegistry()
+        self.user_limiter = TokenBucketLimiter(GLOBAL_USER_RATE, GLOBAL_USER_BURST)
+        self.guild_limiter = TokenBucketLimiter(GLOBAL_GUILD_RATE, GLOBAL_GUILD_BURST)
+        self.registry_loading = None
+        self.registry_watch_task = None
+        self.relays = RelayCache()
+
+    async def cog_load(self):
+        await self.ensure_registry()
+        if GLOBAL_CHAT_CHANGE_STREAM:
+            self.registry_watch_task = asyncio.create_task(self.watch_registry())
+
+    async def cog_unload(self):
+        if self.registry_watch_task:
+            self.registry_watch_task.cancel()
+
+    async def load_registry(self):
+        db = self.bot.async_db["Main"].GlobalChat
+        docs = await db.find({}).to_list(None)
+        self.registry.load(docs)
+        print(f"グローバルチャットのチャンネルを読み込みました: {len(self.registry)}")
+
+    async def ensure_registry(self):
+        # 読み込みに失敗していた場合は次のメッセージで読み込み直す (同時には1回だけ)
+        if self.registry.loaded:
+            return True
+        if self.registry_loading is None or self.registry_loading.done():
+            self.registry_loading = asyncio.ensure_future(self.load_registry())
+        try:
+            await asyncio.shield(self.registry_loading)
+        except Exception as e:
+            print(f"Error in load_registry: {e}")
+        return self.registry.loaded
+
+    async def watch_registry(self):
+        db = self.bot.async_db["Main"].GlobalChat
+        try:
+            async with db.watch(full_document="updateLookup") as stream:
+                async for change in stream:
+                    doc = change.get("fullDocument")
+                    if change.get("operationType") == "delete" or doc is None:
+                        self.registry.remove_id(change.get("documentKey", {}).get("_id"))
+                    elif "Channel" in doc:
+                        self.registry.put(doc)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error in watch_registry: {e}")
+
+    def cache_stats(self):
+        return {
+            "global_registry": {
+                "loaded": self.registry.loaded,
+                "channels": len(self.registry),
+            },
+            "global_relays": self.relays.stats(),
+            "global_user_limit": self.user_limiter.stats(),
+            "global_guild_limit": self.guild_limiter.stats(),
+            "global_fanout": {
+                "fanouts": self.fanout_stats["fanouts"],
+                "delivered": self.fanout_stats["delivered"],
+                "failed": self.fanout_stats["failed"],
+                "rate_limited": self.fanout_stats["rate_limited"],
+                "edited": self.fanout_stats["edited"],
+                "deleted": self.fanout_stats["deleted"],
+                "send_p50_ms": round(percentile(self.send_times, 50) * 1000, 1),
+                "send_p99_ms": round(percentile(self.send_times, 99) * 1000, 1),
+                "delivery_p50_ms": round(percentile(self.delivery_times, 50) * 1000, 1),
+                "delivery_p99_ms": round(percentile(self.delivery_times, 99) * 1000, 1),
+                "fanout_p50_ms": round(percentile(self.fanout_times, 50) * 1000, 1),
+                "fanout_p99_ms": round(percentile(self.fanout_times, 99) * 1000, 1),
+            },
+        }
 
     @commands.Cog.listener("on_message")
     async def on_message_global(self, message: discord.Message):
@@ -17,50 +273,294 @@ class GlobalCog(commands.Cog):
             return
         if type(message.channel) == discord.DMChannel:
             return
-        db = self.bot.async_db["Main"].GlobalChat
-        try:
-            dbfind = await db.find_one({"Channel": message.channel.id}, {"_id": False})
-            if dbfind is None:
-                return
-        except Exception as e:
+        if not self.registry.loaded and not await self.ensure_registry():
+            return
+        if message.channel.id not in self.registry:
             return
-        current_time = time.time()
-        last_message_time = user_last_message_timegc.get(message.guild.id, 0)
-        if current_time - last_message_time < 10:
+        # ユーザーとサーバーの両方に余裕があるときだけ送る (片方だけ減らさない)
+        now = time.monotonic()
+        if self.user_limiter.tokens(message.author.id, now) < 1:
+            if self.user_limiter.throttle(message.author.id):
+                await self.add_throttled_reaction(message)
             return
-        user_last_message_timegc[message.guild.id] = current_time
-        await self.send_global_chat(message)
+        if self.guild_limiter.tokens(message.guild.id, now) < 1:
+            if self.guild_limiter.throttle(message.guild.id):
+                await self.add_throttled_reaction(message)
+            return
+        self.user_limiter.consume(message.author.id, now)
+        self.guild_limiter.consume(message.guild.id, now)
+        ref_msg = None
+        if message.reference and message.reference.message_id:
+            ref_msg = message.reference.resolved if isinstance(message.reference.resolved, discord.Message) else message.reference
+        await self.send_global_chat(message, ref_msg)
         await message.add_reaction("✅")
         
-    async def send_global_chat(self, message: discord.Message, ref_msg: discord.Message = None):
-        db = self.bot.async_db["Main"].GlobalChat
-        channels = db.find({})
+    async def add_throttled_reaction(self, message: discord.Message):
+        try:
+            await message.add_reaction(GLOBAL_THROTTLED_REACTION)
+        except Exception:
+            return
+
+    async def download_attachment(self, attachment: discord.Attachment, directory: str, index: int):
+        # 一時ファイルに少しずつ書き込み、全配信先で同じファイルを使う
+        # 合計サイズは申告サイズで割り当てているので、それを超えるものは転送しない
+        path = os.path.join(directory, f"{index}")
+        max_bytes = min(attachment.size, GLOBAL_ATTACHMENT_MAX_BYTES)
+        size = 0
+        try:
+            async with self.bot.http_session.get(attachment.url, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                if resp.status != 200:
+                    return None
+                if resp.content_length and resp.content_length > max_bytes:
+                    return None
+                with open(path, "wb") as f:
+                    async for chunk in resp.content.iter_chunked(GLOBAL_ATTACHMENT_CHUNK):
+                        size += len(chunk)
+                        if size > max_bytes:
+                            return None
+                        f.write(chunk)
+        except Exception as e:
+            print(f"Error in download_attachment: {e}")
+            return None
+        return (path, attachment.filename, attachment.is_spoiler())
 
-        async for channel in channels:
-            if channel["Channel"] == message.channel.id:
-                continue
+    def attachment_limit(self, channels: list):
+        # 1回の送信の合計サイズは、配信先サーバーのうち一番小さいアップロード上限に収める
+        limits = [GLOBAL_ATTACHMENT_TOTAL_BYTES]
+        for channel in channels:
             target_channel = self.bot.get_channel(channel["Channel"])
             if target_channel:
-                async with aiohttp.ClientSession() as session:
-                    webhook_ = Webhook.from_url(channel.get("WebHook"), session=session)
-                    await webhook_.send(username="PeyanguBot - Global", avatar_url=self.bot.user.avatar.url, embed=discord.Embed(description=message.content[:50], color=discord.Color.blue())
-                                        .set_author(name=message.author.name, icon_url=message.author.avatar.url if message.author.avatar else message.author.default_avatar.url).set_footer(text=f"{message.guild.name} / {message.guild.id}"))
+                limits.append(target_channel.guild.filesize_limit)
+        return min(limits)
+
+    async def download_attachments(self, message: discord.Message, directory: str, limit: int = GLOBAL_ATTACHMENT_TOTAL_BYTES):
+        relayed = []
+        skipped = []
+        total = 0
+        for attachment in message.attachments:
+            content_type = attachment.content_type or ""
+            if len(relayed) >= GLOBAL_ATTACHMENT_MAX_FILES or attachment.size > GLOBAL_ATTACHMENT_MAX_BYTES or total + attachment.size > limit or not content_type.startswith(GLOBAL_ATTACHMENT_TYPES):
+                skipped.append(attachment.filename)
+            else:
+                total += attachment.size
+                relayed.append(attachment)
+        files = await asyncio.gather(*(self.download_attachment(attachment, directory, index) for index, attachment in enumerate(relayed)))
+        skipped += [attachment.filename for attachment, file in zip(relayed, files) if file is None]
+        return [file for file in files if file is not None], skipped
+
+    def global_chat_embed(self, message: discord.Message, skipped: list):
+        embed = discord.Embed(description=message.content[:50], color=discord.Color.blue()).set_author(name=message.author.name, icon_url=message.author.avatar.url if message.author.avatar else message.author.default_avatar.url).set_footer(text=f"{message.guild.name} / {message.guild.id}")
+        if message.stickers:
+            embed.add_field(name="スタンプ", value="\n".join(sticker.name for sticker in message.stickers), inline=False)
+            sticker = message.stickers[0]
+            if sticker.format != discord.StickerFormatType.lottie:
+                embed.set_image(url=sticker.url)
+        if skipped:
+            embed.add_field(name="転送できなかった添付ファイル", value="\n".join(skipped)[:1024], inline=False)
+        return embed
+
+    async def get_relay(self, message_id: int):
+        relay = self.relays.get(message_id)
+        if relay is not None:
+            return relay
+        db = self.bot.async_db["Main"].GlobalChatMessage
+        try:
+            relay = await db.find_one({"$or": [{"Source": message_id}, {"Copies.Message": message_id}]}, {"_id": False})
+        except Exception as e:
+            print(f"Error in get_relay: {e}")
+            return None
+        if relay is not None:
+            self.relays.put(relay)
+        return relay
+
+    def reply_field(self, channel: dict, relay: dict, ref_msg):
+        # Webhookでは返信できないので、返信先への移動リンクを付ける
+        if channel["Channel"] == relay["Channel"]:
+            guild_id, message_id = relay["Guild"], relay["Source"]
+        else:
+            copy = next((copy for copy in relay["Copies"] if copy["Channel"] == channel["Channel"]), None)
+            if copy is None:
+                return None
+            guild_id, message_id = channel["Guild"], copy["Message"]
+        quote = ""
+        if isinstance(ref_msg, discord.Message):
+            if ref_msg.webhook_id and ref_msg.embeds:
+                quote = f"{ref_msg.embeds[0].author.name}: {(ref_msg.embeds[0].description or '')[:50]}\n"
             else:
-                print(f"{channel['Channel']} が見つからないため削除します。")
+                quote = f"{ref_msg.author.name}: {ref_msg.content[:50]}\n"
+        return f"{quote}[メッセージへ移動](https://discord.com/channels/{guild_id}/{channel['Channel']}/{message_id})"
+
+    def reply_embed(self, embed: discord.Embed, reply: str = None):
+        if not reply:
+            return embed
+        # Embed.copy()はfieldsのリストを共有するので、新しいリストにして元の埋め込みを変えない
+        data = embed.to_dict()
+        data["fields"] = data.get("fields", []) + [{"name": "返信先", "value": reply, "inline": False}]
+        return discord.Embed.from_dict(data)
+
+    async def send_global_chat(self, message: discord.Message, ref_msg: discord.Message = None):
+        channels = [channel for channel in self.registry.targets if channel["Channel"] != message.channel.id]
+        relay = await self.get_relay(ref_msg.message_id if isinstance(ref_msg, discord.MessageReference) else ref_msg.id) if ref_msg else None
+        start = time.perf_counter()
+        with tempfile.TemporaryDirectory() as directory:
+            # 添付ファイルは1回だけダウンロードする
+            files, skipped = await self.download_attachments(message, directory, self.attachment_limit(channels)) if message.attachments else ([], [])
+            # 埋め込みは1回だけ作り、全チャンネルへ同時に送る (同時送信数はセマフォで制限)
+            embed = self.global_chat_embed(message, skipped)
+            replies = {channel["Channel"]: self.reply_field(channel, relay, ref_msg) for channel in channels} if relay else {}
+            copies = await asyncio.gather(*(self.deliver_global_chat(channel, self.reply_embed(embed, replies.get(channel["Channel"])), start, files) for channel in channels))
+        self.fanout_times.append(time.perf_counter() - start)
+        self.fanout_stats["fanouts"] += 1
+        # 編集・削除を転送先に反映できるように、転送先のメッセージIDを記録する
+        # 編集時に埋め込みを作り直せるよう、返信先と転送できなかった添付ファイルも残す
+        relay = {
+            "Source": message.id,
+            "Guild": message.guild.id,
+            "Channel": message.channel.id,
+            "Copies": [],
+            "Skipped": skipped,
+            "Time": datetime.datetime.now(datetime.timezone.utc),
+        }
+        for channel_id, message_id in filter(None, copies):
+            copy = {"Channel": channel_id, "Message": message_id}
+            if replies.get(channel_id):
+                copy["Reply"] = replies[channel_id]
+            relay["Copies"].append(copy)
+        self.relays.put(relay)
+        try:
+            await self.bot.async_db["Main"].GlobalChatMessage.insert_one(dict(relay))
+        except Exception as e:
+            print(f"Error in send_global_chat: {e}")
+
+    async def deliver_global_chat(self, channel: dict, embed: discord.Embed, start: float, files: list = None):
+        db = self.bot.async_db["Main"].GlobalChat
+        target_channel = self.bot.get_channel(channel["Channel"])
+        if not target_channel:
+            print(f"{channel['Channel']} が見つからないため削除します。")
+            self.registry.remove(channel["Channel"])
+            await db.delete_one({"Channel": channel["Channel"]})
+            return
+        url = channel.get("WebHook")
+        async with self.fanout_semaphore:
+            bucket = self.bot.webhook_bucket(url)
+            await bucket.acquire()
+            sent = time.perf_counter()
+            try:
+                webhook_ = self.bot.get_webhook(url)
+                # discord.Fileは送信後に閉じられるので配信先ごとに作る (中身はディスクから読む)
+                sent_message = await webhook_.send(username="PeyanguBot - Global", avatar_url=self.bot.user.avatar.url, embed=embed, files=[discord.File(path, filename=filename, spoiler=spoiler) for path, filename, spoiler in files or []], wait=True)
+            except discord.NotFound:
+                print(f"{channel['Channel']} のWebhookが見つからないため削除します。")
+                self.fanout_stats["failed"] += 1
+                self.registry.remove(channel["Channel"])
                 await db.delete_one({"Channel": channel["Channel"]})
-            await asyncio.sleep(1)
-        
+                return
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    self.fanout_stats["rate_limited"] += 1
+                    bucket.limited(getattr(e, "retry_after", None) or 5)
+                print(f"Error in deliver_global_chat: {e}")
+                self.fanout_stats["failed"] += 1
+                return
+            except Exception as e:
+                print(f"Error in deliver_global_chat: {e}")
+                self.fanout_stats["failed"] += 1
+                return
+            now = time.perf_counter()
+            self.send_times.append(now - sent)
+            self.delivery_times.append(now - start)
+            self.fanout_stats["delivered"] += 1
+            return (channel["Channel"], sent_message.id)
+
+    async def update_copy(self, copy: dict, embed: discord.Embed = None):
+        # embedがあれば編集、なければ削除する
+        channel = self.registry.channels.get(copy["Channel"])
+        if channel is None:
+            return
+        url = channel.get("WebHook")
+        async with self.fanout_semaphore:
+            bucket = self.bot.webhook_bucket(url)
+            await bucket.acquire()
+            try:
+                webhook_ = self.bot.get_webhook(url)
+                if embed is None:
+                    await webhook_.delete_message(copy["Message"])
+                    self.fanout_stats["deleted"] += 1
+                else:
+                    await webhook_.edit_message(copy["Message"], embed=embed)
+                    self.fanout_stats["edited"] += 1
+            except discord.NotFound:
+                return
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    self.fanout_stats["rate_limited"] += 1
+                    bucket.limited(getattr(e, "retry_after", None) or 5)
+                print(f"Error in update_copy: {e}")
+            except Exception as e:
+                print(f"Error in update_copy: {e}")
+
+    async def find_source_relay(self, message_id: int, channel_id: int, cached_message: discord.Message = None):
+        # 転送先(Webhook)のメッセージは対象外。転送元のメッセージだけを返す
+        if channel_id not in self.registry:
+            return None
+        if self.relays.is_copy(message_id):
+            return None
+        if cached_message is not None and (cached_message.webhook_id or cached_message.author.bot):
+            return None
+        relay = await self.get_relay(message_id)
+        if relay is None or relay["Source"] != message_id:
+            return None
+        return relay
+
+    @commands.Cog.listener("on_raw_message_edit")
+    async def on_message_edit_global(self, payload: discord.RawMessageUpdateEvent):
+        message = payload.message
+        if message.guild is None or message.webhook_id or message.author.bot:
+            return
+        if payload.cached_message is not None and payload.cached_message.content == message.content:
+            return
+        relay = await self.find_source_relay(message.id, message.channel.id, payload.cached_message)
+        if relay is None:
+            return
+        embed = self.global_chat_embed(message, relay.get("Skipped", []))
+        await asyncio.gather(*(self.update_copy(copy, self.reply_embed(embed, copy.get("Reply"))) for copy in relay["Copies"]))
+
+    async def delete_relay(self, relay: dict):
+        self.relays.remove(relay["Source"])
+        await asyncio.gather(*(self.update_copy(copy) for copy in relay["Copies"]))
+        try:
+            await self.bot.async_db["Main"].GlobalChatMessage.delete_one({"Source": relay["Source"]})
+        except Exception as e:
+            print(f"Error in delete_relay: {e}")
+
+    @commands.Cog.listener("on_raw_message_delete")
+    async def on_message_delete_global(self, payload: discord.RawMessageDeleteEvent):
+        relay = await self.find_source_relay(payload.message_id, payload.channel_id, payload.cached_message)
+        if relay is None:
+            return
+        await self.delete_relay(relay)
+
+    @commands.Cog.listener("on_raw_bulk_message_delete")
+    async def on_bulk_message_delete_global(self, payload: discord.RawBulkMessageDeleteEvent):
+        if payload.channel_id not in self.registry:
+            return
+        cached = {message.id: message for message in payload.cached_messages}
+        relays = await asyncio.gather(*(self.find_source_relay(message_id, payload.channel_id, cached.get(message_id)) for message_id in payload.message_ids))
+        await asyncio.gather(*(self.delete_relay(relay) for relay in relays if relay is not None))
+
     @commands.hybrid_group(name="globalchat", fallback="join", description="グローバルチャットに参加します。")
     @commands.cooldown(2, 10, commands.BucketType.guild)
     async def globalchat_join(self, ctx: commands.Context):
         msg = await ctx.reply(embed=discord.Embed(title="グローバルチャットに参加しています・・", color=discord.Color.blue()))
-        db = self.bot.database.GlobalChat
+        db = self.bot.async_db["Main"].GlobalChat
         web = await ctx.channel.create_webhook(name="Peyangu-Global")
+        doc = {"Guild": ctx.guild.id, "Channel": ctx.channel.id, "WebHook": web.url}
         await db.replace_one(
             {"Guild": ctx.guild.id, "Channel": ctx.channel.id}, 
-            {"Guild": ctx.guild.id, "Channel": ctx.channel.id, "WebHook": web.url}, 
+            doc, 
             upsert=True
         )
+        self.registry.put(doc)
         await asyncio.sleep(2)
         await msg.reply(embed=discord.Embed(title="グローバルチャットに参加しました。", color=discord.Color.green()))
 
@@ -68,10 +568,11 @@ class GlobalCog(commands.Cog):
     @commands.cooldown(2, 10, commands.BucketType.guild)
     async def admin_reload(self, ctx: commands.Context):
         msg = await ctx.reply(embed=discord.Embed(title="グローバルチャットから退出しています・・", color=discord.Color.blue()))
-        db = self.bot.database.GlobalChat
+        db = self.bot.async_db["Main"].GlobalChat
         await db.delete_one(
             {"Guild": ctx.guild.id, "Channel": ctx.channel.id}
         )
+        self.registry.remove(ctx.channel.id)
         await asyncio.sleep(2)
         await msg.reply(embed=discord.Embed(title="グローバルチャットから退出しました。", color=discord.Color.green()))
 
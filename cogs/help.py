@@ -19,6 +19,7 @@ class HelpCog(commands.Cog):
         embed.add_field(name="!reload [cog]", value="Cogを再読み込み（限定ユーザー）", inline=False)
         embed.add_field(name="!unload [cog]", value="Cogをアンロード（限定ユーザー）", inline=False)
         embed.add_field(name="!listcogs", value="読み込み済みのCogを表示（限定ユーザー）", inline=False)
+        embed.add_field(name="!cachestats", value="キャッシュのヒット率を表示（限定ユーザー）", inline=False)
         embed.add_field(name="!shutdown", value="Botを停止（限定ユーザー）", inline=False)
         embed.add_field(name="!restart", value="Botを再起動（限定ユーザー）", inline=False)
 
@@ -1,80 +1,581 @@
-from discord.ext import commands
+from discord.ext import commands, tasks
+from discord import app_commands
 import discord
 import traceback
 import sys
 import logging
 import asyncio
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 import asyncio
 import aiohttp
 import io
 import random
+import time
+import hashlib
+import functools
+import gzip
+import json
+import csv
+import tempfile
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError
+from utils import GuildCache, PagedView
+
+# XPをまとめて書き込む間隔(秒)
+XP_FLUSH_INTERVAL = 10
+# 書き込み待ちがないユーザーの状態をこの件数を超えたら捨てる
+XP_STATE_MAX = 50000
+# ギルド設定キャッシュの最大ギルド数
+GUILD_SETTINGS_CACHE_SIZE = 10000
+# 複数プロセスで動かす場合はTrueにするとchange streamで設定の変更を受け取る (レプリカセットが必要)
+LEVEL_SETTINGS_CHANGE_STREAM = False
+LEVEL_SETTINGS_COLLECTIONS = ["LevelingSetting", "LevelingUpTiming", "LevelingUpAlertChannel", "LevelingUpRole", "LevelingCooldown"]
+# XPをもらえる間隔(秒)のデフォルトと上限。0ならメッセージごとにもらえる
+DEFAULT_XP_COOLDOWN = 0
+XP_COOLDOWN_MAX = 600
+# クールダウンを覚えておく最大人数
+XP_COOLDOWN_MAX_ENTRIES = 1000000
+# レベルアップに必要なXPのデフォルト
+DEFAULT_LEVEL_TIMING = 100
+# ランキング1ページの人数と、ページをキャッシュする秒数
+RANKING_PAGE_SIZE = 10
+RANKING_CACHE_TTL = 30
+RANKING_CACHE_MAX = 1000
+# ランクカードの画像キャッシュ (バイト数の上限)
+CARD_IMAGE_CACHE_BYTES = 32 * 1024 * 1024
+CARD_RENDER_CACHE_BYTES = 16 * 1024 * 1024
+# ダウンロードする背景画像・アバターの最大サイズ
+CARD_IMAGE_MAX_BYTES = 8 * 1024 * 1024
+# 展開後のピクセル数の上限 (小さいファイルでも巨大な画像に展開されることがある)
+CARD_IMAGE_MAX_PIXELS = 4096 * 4096
+CARD_RENDER_WORKERS = 2
+CARD_SIZE = (900, 250)
+# インポート・エクスポートで1回に読み書きする件数
+LEVEL_TRANSFER_BATCH = 1000
+# インポートで受け付ける列名 (MEE6などのダンプの列名も含む)
+LEVEL_IMPORT_FIELDS = {
+    "User": ("User", "user", "user_id", "userId", "id"),
+    "Level": ("Level", "level", "lvl"),
+    "XP": ("XP", "xp", "exp"),
+}
+# /level reconcile で1回に読むドキュメント数と、続けてロールを編集する人数・その後の待ち時間(秒)
+RECONCILE_BATCH = 500
+RECONCILE_CHUNK = 10
+RECONCILE_CHUNK_DELAY = 5
+# ランキングの並び順 (mongo_indexes の {Guild, Level, XP, User} と同じ順)
+RANKING_SORT = [("Level", -1), ("XP", -1), ("User", 1)]
+
+def apply_xp(level: int, xp: int, incs: list, timing: int):
+    """incsを順に足し、区切りごとにレベルアップ判定をする (xp_pipelineと同じ規則)"""
+    for i, inc in enumerate(incs):
+        xp += inc
+        if i < len(incs) - 1 and xp > timing:
+            level += 1
+            xp = 0
+    return level, xp
+
+def xp_pipeline(incs: list, timing: int):
+    """apply_xpと同じ処理をするアップデート用パイプライン"""
+    pipeline = [{"$set": {"Level": {"$ifNull": ["$Level", 0]}, "XP": {"$ifNull": ["$XP", 0]}}}]
+    for i, inc in enumerate(incs):
+        if inc:
+            pipeline.append({"$set": {"XP": {"$add": ["$XP", inc]}}})
+        if i < len(incs) - 1:
+            leveled = {"$gt": ["$XP", timing]}
+            pipeline.append({"$set": {
+                "Level": {"$cond": [leveled, {"$add": ["$Level", 1]}, "$Level"]},
+                "XP": {"$cond": [leveled, 0, "$XP"]},
+            }})
+    return pipeline
+
+def level_transfer_format(filename: str):
+    """ファイル名から(形式, gzip圧縮かどうか)を判定する"""
+    name = filename.lower()
+    compressed = name.endswith(".gz")
+    if compressed:
+        name = name[:-3]
+    if name.endswith(".csv"):
+        return "csv", compressed
+    return "jsonl", compressed
+
+def open_level_transfer(fp, mode: str, compressed: bool):
+    if compressed:
+        fp = gzip.GzipFile(fileobj=fp, mode=mode + "b")
+    return io.TextIOWrapper(fp, encoding="utf-8", newline="")
+
+async def export_leveling(collection, guild_id: int, fp, fmt: str = "jsonl", compressed: bool = True):
+    """ギルドのレベルデータをカーソルで少しずつ読み、fpにJSONLかCSVで書き出す。書き出した件数を返す"""
+    out = open_level_transfer(fp, "w", compressed)
+    writer = csv.writer(out) if fmt == "csv" else None
+    if writer:
+        writer.writerow(["User", "Level", "XP"])
+    count = 0
+    cursor = collection.find({"Guild": guild_id}, {"_id": False, "User": True, "Level": True, "XP": True}).batch_size(LEVEL_TRANSFER_BATCH)
+    async for doc in cursor:
+        if writer:
+            writer.writerow([doc["User"], doc.get("Level", 0), doc.get("XP", 0)])
+        else:
+            out.write(json.dumps({"User": doc["User"], "Level": doc.get("Level", 0), "XP": doc.get("XP", 0)}) + "\n")
+        count += 1
+    out.flush()
+    raw = out.detach()
+    if compressed:
+        # GzipFileを閉じて末尾を書き込む (fp自体は閉じない)
+        raw.close()
+    return count
+
+def read_level_rows(fp, fmt: str = "jsonl", compressed: bool = True):
+    """fpから1行ずつ{"User", "Level", "XP"}を取り出す"""
+    src = open_level_transfer(fp, "r", compressed)
+    rows = csv.DictReader(src) if fmt == "csv" else (json.loads(line) for line in src if line.strip())
+    for line_no, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            # JSONの配列をそのまま渡された場合など、1行が1人分のオブジェクトになっていない
+            raise ValueError(f"{line_no}件目: 1行に1人分のオブジェクトが必要です ({type(row).__name__})")
+        doc = {}
+        for field, names in LEVEL_IMPORT_FIELDS.items():
+            for name in names:
+                if row.get(name) not in (None, ""):
+                    doc[field] = int(row[name])
+                    break
+        if "User" in doc:
+            yield doc
+
+async def import_leveling(collection, guild_id: int, fp, fmt: str = "jsonl", compressed: bool = True):
+    """fpのレベルデータをLEVEL_TRANSFER_BATCH件ずつbulk_writeで書き込む。書き込んだ件数を返す"""
+    ops = []
+    count = 0
+    for doc in read_level_rows(fp, fmt, compressed):
+        ops.append(UpdateOne(
+            {"Guild": guild_id, "User": doc["User"]},
+            {"$set": {"Level": doc.get("Level", 0), "XP": doc.get("XP", 0)}},
+            upsert=True
+        ))
+        if len(ops) >= LEVEL_TRANSFER_BATCH:
+            await collection.bulk_write(ops, ordered=False)
+            count += len(ops)
+            ops = []
+    if ops:
+        await collection.bulk_write(ops, ordered=False)
+        count += len(ops)
+    return count
+
+class XPCooldown:
+    """ユーザーごとのXPのクールダウン
+
+    2世代の辞書を XP_COOLDOWN_MAX 秒ごとに入れ替え、古い世代はまとめて捨てる。
+    キーは (Guild << 64) | User の整数、値は期限(秒)の整数にして小さく保つ。"""
+    def __init__(self, period: int = XP_COOLDOWN_MAX, max_entries: int = XP_COOLDOWN_MAX_ENTRIES):
+        self.period = period
+        self.max_entries = max_entries
+        self.current = {}
+        self.previous = {}
+        self.rotate_at = int(time.monotonic()) + period
+
+    def rotate(self, now: int):
+        self.previous = self.current
+        self.current = {}
+        self.rotate_at = now + self.period
+
+    def active(self, guild_id: int, user_id: int):
+        now = int(time.monotonic())
+        if now >= self.rotate_at:
+            self.rotate(now)
+        key = (guild_id << 64) | user_id
+        deadline = self.current.get(key) or self.previous.get(key)
+        return deadline is not None and deadline > now
+
+    def hit(self, guild_id: int, user_id: int, seconds: int):
+        now = int(time.monotonic())
+        if len(self.current) >= self.max_entries:
+            self.rotate(now)
+        self.current[(guild_id << 64) | user_id] = now + min(seconds, self.period)
+
+    def stats(self):
+        return {"entries": len(self.current) + len(self.previous), "max_entries": self.max_entries * 2}
+
+class RewardLadder:
+    """レベル順に並べたご褒美ロール。二分探索で引く"""
+    def __init__(self, rewards: dict):
+        self.levels = sorted(rewards)
+        self.roles = [rewards[level] for level in self.levels]
+        self.role_ids = set(self.roles)
+
+    def __len__(self):
+        return len(self.levels)
+
+    def __iter__(self):
+        return iter(zip(self.levels, self.roles))
+
+    def role_at(self, level: int):
+        i = bisect.bisect_left(self.levels, level)
+        if i < len(self.levels) and self.levels[i] == level:
+            return self.roles[i]
+        return None
+
+    def roles_until(self, level: int):
+        """levelまでにもらえるロールをすべて返す"""
+        return set(self.roles[:bisect.bisect_right(self.levels, level)])
+
+class ByteLRUCache:
+    """合計バイト数で上限をかけたLRUキャッシュ"""
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.data = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        old = self.data.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.data[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self.data.popitem(last=False)
+            self.size -= len(evicted)
+
+    def stats(self):
+        return {"entries": len(self.data), "bytes": self.size, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+@functools.lru_cache(maxsize=None)
+def load_card_font(size: int):
+    for name in ("arial.ttf", "DejaVuSans.ttf"):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        return ImageFont.load_default()
+
+def open_card_image(data: bytes, size: tuple):
+    """画像を開いてRGBにする。展開する前にピクセル数を確かめ、大きすぎるものは読まない"""
+    image = Image.open(io.BytesIO(data))
+    if image.width * image.height > CARD_IMAGE_MAX_PIXELS:
+        raise ValueError(f"画像が大きすぎます: {image.width}x{image.height}")
+    # JPEGは展開しながら縮小できる
+    image.draft("RGB", size)
+    return image.convert("RGB")
+
+def render_rank_card(avatar: bytes, background: bytes, name: str, level: int, xp: int, timing: int, rank: int):
+    """ランクカードをPNGで描画する (スレッドプールで実行する)"""
+    width, height = CARD_SIZE
+    card = None
+    if background:
+        try:
+            card = ImageOps.fit(open_card_image(background, CARD_SIZE), CARD_SIZE)
+            card = Image.blend(card, Image.new("RGB", CARD_SIZE, (0, 0, 0)), 0.45)
+        except Exception:
+            card = None
+    if card is None:
+        card = Image.new("RGB", CARD_SIZE, (35, 39, 42))
+    draw = ImageDraw.Draw(card)
+
+    if avatar:
+        try:
+            icon = ImageOps.fit(open_card_image(avatar, (180, 180)), (180, 180))
+            mask = Image.new("L", (180, 180), 0)
+            ImageDraw.Draw(mask).ellipse((0, 0, 179, 179), fill=255)
+            card.paste(icon, (35, 35), mask)
+        except Exception:
+            pass
+
+    draw.text((250, 40), name, font=load_card_font(40), fill=(255, 255, 255))
+    draw.text((250, 100), f"Level {level}", font=load_card_font(30), fill=(255, 215, 0))
+    draw.text((width - 40, 100), f"Rank #{rank}", font=load_card_font(30), fill=(255, 255, 255), anchor="ra")
+    draw.text((width - 40, 140), f"{xp} / {timing} XP", font=load_card_font(22), fill=(200, 200, 200), anchor="ra")
+
+    bar = (250, 175, width - 40, 205)
+    draw.rounded_rectangle(bar, radius=15, fill=(72, 75, 78))
+    progress = min(max(xp / timing, 0), 1) if timing else 0
+    if progress > 0:
+        draw.rounded_rectangle((bar[0], bar[1], bar[0] + max(int((bar[2] - bar[0]) * progress), 30), bar[3]), radius=15, fill=(88, 101, 242))
+
+    buffer = io.BytesIO()
+    card.save(buffer, format="PNG")
+    return buffer.getvalue()
 
 class LevelCog(commands.Cog):
+    mongo_indexes = {
+        "Leveling": [
+            ([("Guild", 1), ("User", 1)], {"unique": True}),
+            ([("Guild", 1), ("Level", -1), ("XP", -1), ("User", 1)], {}),
+        ],
+        "LevelingSetting": [([("Guild", 1)], {"unique": True})],
+        "LevelingUpTiming": [([("Guild", 1)], {"unique": True})],
+        "LevelingUpAlertChannel": [([("Guild", 1)], {})],
+        "LevelingUpRole": [([("Guild", 1), ("Level", 1)], {})],
+        "LevelingBackImage": [([("User", 1)], {"unique": True})],
+        "LevelingCooldown": [([("Guild", 1)], {"unique": True})],
+    }
+    mongo_queries = {
+        "Leveling": [("Guild", "User"), ("Guild",), ("Guild", "Level", "XP", "User"), ("Guild", "Level", "XP")],
+        "LevelingSetting": [("Guild",)],
+        "LevelingUpTiming": [("Guild",)],
+        "LevelingUpAlertChannel": [("Guild",), ("Guild", "Channel")],
+        "LevelingUpRole": [("Guild",), ("Guild", "Level")],
+        "LevelingBackImage": [("User",)],
+        "LevelingCooldown": [("Guild",)],
+    }
+
     def __init__(self, bot):
         self.bot = bot
+        self.xp_state = {}    # (Guild, User): [Level, XP] DBの値 + 未書き込み分
+        self.xp_pending = {}  # (Guild, User): bulk_writeで送る更新内容
+        self.xp_loading = {}  # (Guild, User): 初めて見たユーザーをDBで加算しているTask
+        self.xp_flush_lock = asyncio.Lock()
+        self.settings_cache = GuildCache(GUILD_SETTINGS_CACHE_SIZE)
+        self.image_cache = ByteLRUCache(CARD_IMAGE_CACHE_BYTES)  # URL: 画像
+        self.card_cache = ByteLRUCache(CARD_RENDER_CACHE_BYTES)  # (User, Level, XP, 順位, アバター, 背景のハッシュ): 描画済みカード
+        self.card_executor = ThreadPoolExecutor(max_workers=CARD_RENDER_WORKERS, thread_name_prefix="rankcard")
+        self.xp_cooldown = XPCooldown()
+        self.reconciling = set()
+        self.ranking_cache = {}  # (Guild, page): (期限, ドキュメント)  pageがNoneのときはページ数
+        self.settings_watch_task = None
         print(f"init -> LevelCog")
 
+    async def cog_load(self):
+        self.flush_xp_loop.start()
+        if LEVEL_SETTINGS_CHANGE_STREAM:
+            self.settings_watch_task = asyncio.create_task(self.watch_settings())
+
+    async def cog_unload(self):
+        self.flush_xp_loop.cancel()
+        if self.settings_watch_task:
+            self.settings_watch_task.cancel()
+        await self.flush_pending()
+        self.card_executor.shutdown(wait=False)
+
+    def cache_stats(self):
+        return {
+            "level_settings": self.settings_cache.stats(),
+            "level_cooldown": self.xp_cooldown.stats(),
+            "level_images": self.image_cache.stats(),
+            "level_cards": self.card_cache.stats(),
+        }
+
+    async def fetch_image(self, url: str):
+        if not url:
+            return None
+        data = self.image_cache.get(url)
+        if data is not None:
+            return data
+        try:
+            async with self.bot.http_session.get(url, timeout=aiohttp.ClientTimeout(total=15)) as resp:
+                if resp.status != 200:
+                    return None
+                chunks = []
+                size = 0
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    size += len(chunk)
+                    if size > CARD_IMAGE_MAX_BYTES:
+                        return None
+                    chunks.append(chunk)
+        except Exception as e:
+            print(f"Error in fetch_image: {e}")
+            return None
+        data = b"".join(chunks)
+        self.image_cache.put(url, data)
+        return data
+
+    async def make_rank_card(self, member: discord.Member, level: int, xp: int, timing: int, rank: int):
+        avatar_url = member.display_avatar.replace(format="png", size=256).url
+        background_url = await self.get_user_image(member)
+        avatar, background = await asyncio.gather(self.fetch_image(avatar_url), self.fetch_image(background_url))
+        background_hash = hashlib.sha1(background).hexdigest() if background else None
+        key = (member.id, level, xp, rank, avatar_url, background_hash)
+        card = self.card_cache.get(key)
+        if card is not None:
+            return card
+        loop = asyncio.get_running_loop()
+        card = await loop.run_in_executor(self.card_executor, render_rank_card, avatar, background, member.name, level, xp, timing, rank)
+        self.card_cache.put(key, card)
+        return card
+
+    async def get_rank(self, guild_id: int, user_id: int, level: int, xp: int):
+        db = self.bot.async_db["Main"].Leveling
+        # 自分より上の人数をインデックスで数える (同点はRANKING_SORTと同じくUserの小さい順)
+        higher = await db.count_documents({"Guild": guild_id, "$or": [
+            {"Level": {"$gt": level}},
+            {"Level": level, "XP": {"$gt": xp}},
+            {"Level": level, "XP": xp, "User": {"$lt": user_id}},
+        ]})
+        return higher + 1
+
+    async def load_settings(self, guild_id: int):
+        main = self.bot.async_db["Main"]
+        enabled, timing, channel, roles, cooldown = await asyncio.gather(
+            main.LevelingSetting.find_one({"Guild": guild_id}, {"_id": False}),
+            main.LevelingUpTiming.find_one({"Guild": guild_id}, {"_id": False}),
+            main.LevelingUpAlertChannel.find_one({"Guild": guild_id}, {"_id": False}),
+            main.LevelingUpRole.find({"Guild": guild_id}, {"_id": False}).to_list(length=None),
+            main.LevelingCooldown.find_one({"Guild": guild_id}, {"_id": False}),
+        )
+        return {
+            "enabled": enabled is not None,
+            "timing": timing["Timing"] if timing else None,
+            "channel": channel["Channel"] if channel else None,
+            "roles": RewardLadder({r["Level"]: r["Role"] for r in roles if "Level" in r and "Role" in r}),
+            "cooldown": cooldown["Seconds"] if cooldown else DEFAULT_XP_COOLDOWN,
+        }
+
+    async def get_settings(self, guild: discord.Guild):
+        # 同じギルドの読み込みが同時に走らないようにする
+        return await self.settings_cache.get_or_load(guild.id, lambda: self.load_settings(guild.id))
+
+    async def watch_settings(self):
+        db = self.bot.async_db["Main"]
+        pipeline = [{"$match": {"ns.coll": {"$in": LEVEL_SETTINGS_COLLECTIONS}}}]
+        try:
+            async with db.watch(pipeline, full_document="updateLookup") as stream:
+                async for change in stream:
+                    doc = change.get("fullDocument")
+                    if doc and "Guild" in doc:
+                        self.settings_cache.invalidate(doc["Guild"])
+                    else:
+                        # 削除ではGuildが分からないので全体を捨てる
+                        self.settings_cache.invalidate()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error in watch_settings: {e}")
+
+    async def flush_pending(self):
+        await self.flush_xp()
+
+    def queue_xp(self, guild_id: int, user_id: int, incs: list, timing: int):
+        # incsの区切りはレベルアップ判定の位置 (apply_xpと同じ)
+        pending = self.xp_pending.get((guild_id, user_id))
+        if pending is None:
+            self.xp_pending[(guild_id, user_id)] = {"incs": list(incs), "timing": timing}
+            return
+        pending["incs"][-1] += incs[0]
+        pending["incs"].extend(incs[1:])
+        pending["timing"] = timing
+
+    async def flush_xp(self):
+        async with self.xp_flush_lock:
+            if not self.xp_pending:
+                return
+            pending, self.xp_pending = self.xp_pending, {}
+            ops = []
+            for (guild_id, user_id), update in pending.items():
+                if len(update["incs"]) == 1:
+                    # レベルアップがなければ単純な$incで済む
+                    ops.append(UpdateOne({"Guild": guild_id, "User": user_id}, {"$inc": {"XP": update["incs"][0]}, "$setOnInsert": {"Level": 0}}, upsert=True))
+                else:
+                    ops.append(UpdateOne({"Guild": guild_id, "User": user_id}, xp_pipeline(update["incs"], update["timing"]), upsert=True))
+            try:
+                await self.bot.async_db["Main"].Leveling.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                # ordered=Falseなので失敗した操作以外は書き込まれている。失敗した分だけ次回に回す
+                print(f"Error in flush_xp: {len(e.details.get('writeErrors', []))}件の書き込みに失敗しました")
+                keys = list(pending)
+                failed = {keys[error["index"]]: pending[keys[error["index"]]] for error in e.details.get("writeErrors", [])}
+                self.requeue_xp(failed)
+                return
+            except Exception as e:
+                print(f"Error in flush_xp: {e}")
+                self.requeue_xp(pending)
+                return
+            if len(self.xp_state) > XP_STATE_MAX:
+                self.xp_state = {k: v for k, v in self.xp_state.items() if k in self.xp_pending}
+
+    def requeue_xp(self, pending: dict):
+        # 書き込めなかった分は次回に回す (その間に来た更新はその後ろにつなげる)
+        newer, self.xp_pending = self.xp_pending, pending
+        for (guild_id, user_id), update in newer.items():
+            self.queue_xp(guild_id, user_id, update["incs"], update["timing"])
+
+    @tasks.loop(seconds=XP_FLUSH_INTERVAL)
+    async def flush_xp_loop(self):
+        await self.flush_xp()
+
+    @flush_xp_loop.before_loop
+    async def before_flush_xp_loop(self):
+        await self.bot.wait_until_ready()
+
     async def check_level_enabled(self, guild: discord.Guild):
-        db = self.bot.async_db["Main"].LevelingSetting
         try:
-            dbfind = await db.find_one({"Guild": guild.id}, {"_id": False})
+            settings = await self.get_settings(guild)
         except:
             return False
-        if dbfind is None:
-            return False
+        return settings["enabled"]
+
+    async def grant_xp(self, guild_id: int, user_id: int, inc: int = 0, timing: int = None, level: int = None, xp: int = None, upsert: bool = True):
+        """XPの加算とレベルアップ判定を1回のfind_one_and_updateで行い、(更新前, 更新後)の(Level, XP)を返す
+
+        levelを渡すとLevelとXPをその値にする。inc、timing、levelがどれもなければ読み込みだけ行う。
+        ドキュメントがない場合、更新前はNoneになる。"""
+        db = self.bot.async_db["Main"].Leveling
+        query = {"Guild": guild_id, "User": user_id}
+        if level is None and not inc and timing is None:
+            dbfind = await db.find_one(query, {"_id": False, "Level": True, "XP": True})
+            state = (dbfind["Level"], dbfind["XP"]) if dbfind else None
+            return state, state
+        if level is not None:
+            update = [{"$set": {"Level": {"$literal": level}, "XP": {"$literal": xp}}}]
         else:
-            return True
+            incs = [inc] if timing is None else [inc, 0]
+            update = xp_pipeline(incs, timing)
+        dbfind = await db.find_one_and_update(
+            query,
+            update,
+            projection={"_id": False, "Level": True, "XP": True},
+            upsert=upsert,
+            return_document=ReturnDocument.BEFORE
+        )
+        before = (dbfind.get("Level", 0), dbfind.get("XP", 0)) if dbfind else None
+        if level is not None:
+            after = (level, xp)
+        elif before is None and not upsert:
+            after = None
+        else:
+            after = apply_xp(*(before or (0, 0)), incs, timing)
+        return before, after
 
     async def new_user_write(self, guild: discord.Guild, user: discord.User):
         try:
-            db = self.bot.async_db["Main"].Leveling
-            await db.replace_one(
-                {"Guild": guild.id, "User": user.id}, 
-                {"Guild": guild.id, "User": user.id, "Level": 0, "XP": 1}, 
-                upsert=True
-            )
+            await self.grant_xp(guild.id, user.id, level=0, xp=1)
         except:
             return
         
     async def user_write(self, guild: discord.Guild, user: discord.User, level: int, xp: int):
         try:
-            db = self.bot.async_db["Main"].Leveling
-            await db.replace_one(
-                {"Guild": guild.id, "User": user.id}, 
-                {"Guild": guild.id, "User": user.id, "Level": level, "XP": xp}, 
-                upsert=True
-            )
+            await self.grant_xp(guild.id, user.id, level=level, xp=xp)
         except:
             return
         
     async def get_level(self, guild: discord.Guild, user: discord.User):
         try:
-            db = self.bot.async_db["Main"].Leveling
-            try:
-                dbfind = await db.find_one({"Guild": guild.id, "User": user.id}, {"_id": False})
-            except:
-                return None
-            if dbfind is None:
-                return None
-            else:
-                return dbfind["Level"]
+            before, after = await self.grant_xp(guild.id, user.id, upsert=False)
         except:
-            return
+            return None
+        return after[0] if after else None
         
     async def get_xp(self, guild: discord.Guild, user: discord.User):
         try:
-            db = self.bot.async_db["Main"].Leveling
-            try:
-                dbfind = await db.find_one({"Guild": guild.id, "User": user.id}, {"_id": False})
-            except:
-                return None
-            if dbfind is None:
-                return None
-            else:
-                return dbfind["XP"]
+            before, after = await self.grant_xp(guild.id, user.id, upsert=False)
         except:
-            return
+            return None
+        return after[1] if after else None
         
     async def set_user_image(self, user: discord.User, url: str):
         try:
@@ -117,94 +618,120 @@ class LevelCog(commands.Cog):
             )
         except:
             return
+        finally:
+            self.settings_cache.invalidate(guild.id)
 
     async def get_channel(self, guild: discord.Guild):
         try:
-            db = self.bot.async_db["Main"].LevelingUpAlertChannel
-            try:
-                dbfind = await db.find_one({"Guild": guild.id}, {"_id": False})
-            except:
-                return None
-            if dbfind is None:
-                return None
-            else:
-                return dbfind["Channel"]
+            settings = await self.get_settings(guild)
         except:
-            return
+            return None
+        return settings["channel"]
         
     async def set_role(self, guild: discord.Guild, level: int, role: discord.Role = None, ):
         db = self.bot.async_db["Main"].LevelingUpRole
         try:
             if role is None:
-                await db.delete_one({"Guild": guild.id})
+                await db.delete_one({"Guild": guild.id, "Level": level})
                 return
             
             await db.replace_one(
-                {"Guild": guild.id}, 
+                {"Guild": guild.id, "Level": level}, 
                 {"Guild": guild.id, "Role": role.id, "Level": level}, 
                 upsert=True
             )
         except Exception as e:
             print(f"Error in set_role: {e}")
+        finally:
+            self.settings_cache.invalidate(guild.id)
 
     async def get_role(self, guild: discord.Guild, level: int):
-        db = self.bot.async_db["Main"].LevelingUpRole
         try:
-            dbfind = await db.find_one({"Guild": guild.id, "Level": level}, {"_id": False})
-            return dbfind["Role"] if dbfind else None
+            settings = await self.get_settings(guild)
         except Exception as e:
             return None
+        return settings["roles"].role_at(level)
         
     async def get_timing(self, guild: discord.Guild):
-        db = self.bot.async_db["Main"].LevelingUpTiming
         try:
-            dbfind = await db.find_one({"Guild": guild.id}, {"_id": False})
-            return dbfind["Timing"] if dbfind else None
+            settings = await self.get_settings(guild)
         except Exception as e:
             return None
+        return settings["timing"]
 
     @commands.Cog.listener("on_message")
     async def on_message_level(self, message: discord.Message):
         if message.author.bot:
             return
+        if message.guild is None:
+            return
+        # クールダウン中ならDBにもキャッシュにも触らずに終わる
+        if self.xp_cooldown.active(message.guild.id, message.author.id):
+            return
         try:
-            enabled = await self.check_level_enabled(message.guild)
+            settings = await self.get_settings(message.guild)
         except:
             return
-        if enabled:
-            db = self.bot.async_db["Main"].Leveling
+        if not settings["enabled"]:
+            return
+        if settings["cooldown"]:
+            self.xp_cooldown.hit(message.guild.id, message.author.id, settings["cooldown"])
+        timing = settings["timing"]
+        tm = DEFAULT_LEVEL_TIMING
+        if not timing is None:
+            tm = timing
+        key = (message.guild.id, message.author.id)
+        inc = random.randint(0, 2)
+        state = self.xp_state.get(key)
+        if state is None and key not in self.xp_loading:
+            # 初めて見たユーザーはDBで直接加算して、結果をそのまま状態にする (読み込みは1ユーザー1回だけ)
+            task = self.xp_loading[key] = asyncio.ensure_future(self.grant_xp(message.guild.id, message.author.id, inc, tm))
             try:
-                dbfind = await db.find_one({"Guild": message.guild.id, "User": message.author.id}, {"_id": False})
+                before, after = await asyncio.shield(task)
             except:
                 return
-            if dbfind is None:
-                return await self.new_user_write(message.guild, message.author)
+            finally:
+                self.xp_loading.pop(key, None)
+            state = self.xp_state.get(key)
+            if state is None:
+                state = self.xp_state[key] = list(after)
+                lv = before[0] if before else 0
             else:
-                await self.user_write(message.guild, message.author, dbfind["Level"], dbfind["XP"] + random.randint(0, 2))
-                xp = await self.get_xp(message.guild, message.author)
-                timing = await self.get_timing(message.guild)
-                tm = 100
-                if not timing is None:
-                    tm = timing
-                if xp > tm:
-                    lv = await self.get_level(message.guild, message.author)
-                    await self.user_write(message.guild, message.author, lv + 1, 0)
-                    lvg = await self.get_level(message.guild, message.author)
-                    cha = await self.get_channel(message.guild)
-                    role = await self.get_role(message.guild, lvg)
-                    if role:
-                        grole = message.guild.get_role(role)
-                        if grole:
-                            await message.author.add_roles(grole)
-                    try:
-                        if cha:
-                            await self.bot.get_channel(cha).send(embed=discord.Embed(title=f"`{message.author.name}`さんの\nレベルが{lvg}になったよ！", color=discord.Color.gold()))
-                        else:
-                            return await message.reply(f"レベルが「{lvg}レベル」になったよ！")
-                    except:
-                        return
+                # 読み込み中に設定コマンドなどで状態が入った場合は、そちらを正とする
+                lv = state[0]
         else:
-            return
+            if state is None:
+                # 同じユーザーの読み込みが終わるのを待ってから、その状態に加算する
+                try:
+                    await asyncio.shield(self.xp_loading[key])
+                except:
+                    return
+                state = self.xp_state.get(key)
+                if state is None:
+                    return
+            lv = state[0]
+            state[:] = apply_xp(state[0], state[1], [inc, 0], tm)
+            self.queue_xp(message.guild.id, message.author.id, [inc, 0] if state[0] > lv else [inc], tm)
+        if state[0] > lv:
+            lvg = state[0]
+            cha = await self.get_channel(message.guild)
+            settings = await self.get_settings(message.guild)
+            # 飛ばしたレベルの分も含めて、まだ持っていないご褒美ロールを付ける
+            have = {r.id for r in getattr(message.author, "roles", [])}
+            grant = [message.guild.get_role(r) for r in settings["roles"].roles_until(lvg) - have]
+            grant = [r for r in grant if r]
+            if grant:
+                try:
+                    await message.author.add_roles(*grant, reason=f"レベル{lvg}のご褒美")
+                except discord.HTTPException as e:
+                    print(f"Error in on_message_level add_roles: {e}")
+            try:
+                if cha:
+                    await self.bot.get_channel(cha).send(embed=discord.Embed(title=f"`{message.author.name}`さんの\nレベルが{lvg}になったよ！", color=discord.Color.gold()))
+                else:
+                    return await message.reply(f"レベルが「{lvg}レベル」になったよ！")
+            except:
+                return
 
     @commands.hybrid_group(name="level", description="レベルを有効化&無効化します。", fallback="setting")
     @commands.cooldown(2, 10, commands.BucketType.guild)
@@ -223,11 +750,13 @@ class LevelCog(commands.Cog):
                     {"Guild": ctx.guild.id},
                     upsert=True
                 )
+                self.settings_cache.invalidate(ctx.guild.id)
                 await ctx.channel.send(embed=discord.Embed(title="レベリングをONにしました。", color=discord.Color.green()))
             else:
                 await db.delete_one(
                     {"Guild": ctx.guild.id}
                 )
+                self.settings_cache.invalidate(ctx.guild.id)
                 await ctx.channel.send(embed=discord.Embed(title="レベリングをOFFにしました。", color=discord.Color.red()))
         except:
             return await ctx.reply(f"{sys.exc_info()}")
@@ -245,16 +774,34 @@ class LevelCog(commands.Cog):
         else:
             avatar = ctx.author.default_avatar.url
         if enabled:
-            lv = await self.get_level(ctx.guild, ctx.author)
-            if lv == None:
-                return await ctx.reply(embed=discord.Embed(title=f"`{ctx.author.name}`のレベル", description=f"レベル: 「0レベル」\nXP: 「0XP」", color=discord.Color.blue()).set_thumbnail(url=avatar))
-            xp = await self.get_xp(ctx.guild, ctx.author)
-            if xp == None:
-                return await ctx.reply(embed=discord.Embed(title=f"`{ctx.author.name}`のレベル", description=f"レベル: 「0レベル」\nXP: 「0XP」", color=discord.Color.blue()).set_thumbnail(url=avatar))
-            await ctx.reply(embed=discord.Embed(title=f"`{ctx.author.name}`のレベル", description=f"レベル: 「{lv}レベル」\nXP: 「{xp}XP」", color=discord.Color.blue()).set_thumbnail(url=avatar))
+            state = self.xp_state.get((ctx.guild.id, ctx.author.id))
+            if state is None:
+                before, state = await self.grant_xp(ctx.guild.id, ctx.author.id, upsert=False)
+            lv, xp = state or (0, 0)
+            timing = await self.get_timing(ctx.guild) or DEFAULT_LEVEL_TIMING
+            try:
+                await self.flush_xp()
+                rank = await self.get_rank(ctx.guild.id, ctx.author.id, lv, xp)
+                card = await self.make_rank_card(ctx.author, lv, xp, timing, rank)
+            except Exception as e:
+                print(f"Error in level_show: {e}")
+                return await ctx.reply(embed=discord.Embed(title=f"`{ctx.author.name}`のレベル", description=f"レベル: 「{lv}レベル」\nXP: 「{xp}XP」", color=discord.Color.blue()).set_thumbnail(url=avatar))
+            await ctx.reply(file=discord.File(io.BytesIO(card), filename="rank.png"))
         else:
             return await ctx.reply(embed=discord.Embed(title="レベルは無効です。", color=discord.Color.red()))
         
+    @level_setting.command(name="background", description="ランクカードの背景画像を設定します。")
+    @commands.cooldown(2, 10, commands.BucketType.user)
+    async def level_background(self, ctx: commands.Context, url: str = None):
+        await ctx.defer()
+        if url is None:
+            await self.bot.async_db["Main"].LevelingBackImage.delete_one({"User": ctx.author.id})
+            return await ctx.reply(embed=discord.Embed(title="背景画像を削除しました。", color=discord.Color.green()))
+        if not url.startswith("https://"):
+            return await ctx.reply(embed=discord.Embed(title="https://から始まる画像のURLを指定してください。", color=discord.Color.red()))
+        await self.set_user_image(ctx.author, url)
+        return await ctx.reply(embed=discord.Embed(title="背景画像を設定しました。", color=discord.Color.green()))
+
     @level_setting.command(name="channel", description="レベルアップの通知のチャンネルを設定します。")
     @commands.cooldown(2, 10, commands.BucketType.guild)
     @commands.has_permissions(manage_channels=True)
@@ -303,6 +850,9 @@ class LevelCog(commands.Cog):
             return await ctx.reply(embed=discord.Embed(title="レベルは無効です。", color=discord.Color.red()))
         if not enabled:
             return await ctx.reply(embed=discord.Embed(title="レベルは無効です。", color=discord.Color.red()))
+        key = (ctx.guild.id, ユーザー.id)
+        self.xp_pending.pop(key, None)
+        self.xp_state[key] = [レベル, xp]
         await self.user_write(ctx.guild, ユーザー, レベル, xp)
         return await ctx.reply(embed=discord.Embed(title="レベルを編集しました。", description=f"ユーザー: 「{ユーザー.name}」\nレベル: 「{レベル}レベル」\nXP: 「{xp}XP」", color=discord.Color.green()))
     
@@ -325,8 +875,162 @@ class LevelCog(commands.Cog):
             {"Guild": ctx.guild.id, "Timing": xp}, 
             upsert=True
         )
+        self.settings_cache.invalidate(ctx.guild.id)
         return await ctx.reply(embed=discord.Embed(title="レベルアップするタイミングを設定しました。", color=discord.Color.green(), description=f"タイミング: {xp}XP"))
     
+    @level_setting.command(name="cooldown", description="XPをもらえる間隔を設定します。")
+    @commands.cooldown(2, 10, commands.BucketType.guild)
+    @commands.has_permissions(manage_channels=True)
+    async def level_cooldown(self, ctx: commands.Context, 秒: int):
+        await ctx.defer()
+        try:
+            enabled = await self.check_level_enabled(ctx.guild)
+        except:
+            return await ctx.reply(embed=discord.Embed(title="レベルは無効です。", color=discord.Color.red()))
+        if not enabled:
+            return await ctx.reply(embed=discord.Embed(title="レベルは無効です。", color=discord.Color.red()))
+        if 秒 < 0 or 秒 > XP_COOLDOWN_MAX:
+            return await ctx.reply(embed=discord.Embed(title=f"間隔は0から{XP_COOLDOWN_MAX}秒でお願いします。", color=discord.Color.red()))
+        db = self.bot.async_db["Main"].LevelingCooldown
+        await db.replace_one(
+            {"Guild": ctx.guild.id}, 
+            {"Guild": ctx.guild.id, "Seconds": 秒}, 
+            upsert=True
+        )
+        self.settings_cache.invalidate(ctx.guild.id)
+        return await ctx.reply(embed=discord.Embed(title="XPをもらえる間隔を設定しました。", color=discord.Color.green(), description=f"間隔: {秒}秒"))
+
+    async def reconcile_rewards(self, guild: discord.Guild, progress: discord.Message = None):
+        """レベルデータを少しずつ読み、ご褒美ロールの付け忘れ・付けすぎを直す"""
+        await self.flush_xp()
+        ladder = (await self.get_settings(guild))["roles"]
+        result = {"checked": 0, "fixed": 0, "missing": 0, "failed": 0}
+        if not len(ladder):
+            return result
+        db = self.bot.async_db["Main"].Leveling
+        calls = 0
+        last_user = None
+        while True:
+            # 長い間開いたカーソルはタイムアウトするので、ユーザーID順に短いクエリで1ページずつ読む
+            query = {"Guild": guild.id}
+            if last_user is not None:
+                query["User"] = {"$gt": last_user}
+            docs = await db.find(query, {"_id": False, "User": True, "Level": True}).sort("User", 1).limit(RECONCILE_BATCH).to_list(RECONCILE_BATCH)
+            if not docs:
+                break
+            last_user = docs[-1]["User"]
+            for doc in docs:
+                result["checked"] += 1
+                member = guild.get_member(doc["User"])
+                if member is None:
+                    # membersインテントがないとキャッシュにはほとんどいないのでAPIで取得する
+                    calls += 1
+                    if calls % RECONCILE_CHUNK == 0:
+                        await self.reconcile_pause(result, progress)
+                    try:
+                        member = await guild.fetch_member(doc["User"])
+                    except discord.NotFound:
+                        result["missing"] += 1
+                        continue
+                    except discord.HTTPException as e:
+                        print(f"Error in reconcile_rewards: {e}")
+                        result["failed"] += 1
+                        continue
+                have = {r.id for r in member.roles} & ladder.role_ids
+                want = ladder.roles_until(doc.get("Level", 0))
+                if have == want:
+                    continue
+                # 追加と削除を1回の編集にまとめる
+                roles = [r for r in member.roles[1:] if r.id not in have - want]
+                roles += [r for r in (guild.get_role(i) for i in want - have) if r]
+                try:
+                    await member.edit(roles=roles, reason="レベルのご褒美ロールの調整")
+                    result["fixed"] += 1
+                except discord.HTTPException as e:
+                    print(f"Error in reconcile_rewards: {e}")
+                    result["failed"] += 1
+                calls += 1
+                if calls % RECONCILE_CHUNK == 0:
+                    await self.reconcile_pause(result, progress)
+        return result
+
+    async def reconcile_pause(self, result: dict, progress: discord.Message = None):
+        # メンバーの取得とロールの編集はRECONCILE_CHUNK回ごとに間をあける (レート制限対策)
+        await asyncio.sleep(RECONCILE_CHUNK_DELAY)
+        if progress:
+            try:
+                await progress.edit(embed=discord.Embed(title="ご褒美ロールを調整しています・・", description=f"確認: {result['checked']}人\n修正: {result['fixed']}人", color=discord.Color.blue()))
+            except discord.HTTPException:
+                pass
+
+    @level_setting.command(name="reconcile", description="全員のご褒美ロールをレベルに合わせて直します。")
+    @commands.cooldown(1, 600, commands.BucketType.guild)
+    @commands.has_permissions(manage_roles=True)
+    async def level_reconcile(self, ctx: commands.Context):
+        await ctx.defer()
+        if ctx.guild.id in self.reconciling:
+            return await ctx.reply(embed=discord.Embed(title="すでに調整中です。", color=discord.Color.red()))
+        self.reconciling.add(ctx.guild.id)
+        try:
+            # 時間がかかるので進捗は普通のメッセージで出す
+            await ctx.reply(embed=discord.Embed(title="ご褒美ロールの調整を開始しました。", color=discord.Color.blue()))
+            progress = await ctx.channel.send(embed=discord.Embed(title="ご褒美ロールを調整しています・・", color=discord.Color.blue()))
+            try:
+                result = await self.reconcile_rewards(ctx.guild, progress)
+            except Exception as e:
+                print(f"Error in level_reconcile: {e}")
+                return await progress.edit(embed=discord.Embed(title="ご褒美ロールの調整に失敗しました。", description="途中までの変更は反映されています。もう一度実行してください。", color=discord.Color.red()))
+            await progress.edit(embed=discord.Embed(title="ご褒美ロールの調整が完了しました。", description=f"確認: {result['checked']}人\n修正: {result['fixed']}人\n失敗: {result['failed']}人\nサーバーにいない: {result['missing']}人", color=discord.Color.green()))
+        finally:
+            self.reconciling.discard(ctx.guild.id)
+
+    def forget_guild_xp(self, guild_id: int):
+        # インポートなどでDBを直接書き換えたあと、メモリ上の状態を捨てる
+        self.xp_state = {k: v for k, v in self.xp_state.items() if k[0] != guild_id}
+        self.xp_pending = {k: v for k, v in self.xp_pending.items() if k[0] != guild_id}
+        self.ranking_cache = {k: v for k, v in self.ranking_cache.items() if k[0] != guild_id}
+
+    @level_setting.command(name="export", description="レベルデータをファイルに書き出します。")
+    @commands.cooldown(1, 60, commands.BucketType.guild)
+    @commands.has_permissions(administrator=True)
+    @app_commands.choices(形式=[
+        app_commands.Choice(name="JSONL", value="jsonl"),
+        app_commands.Choice(name="CSV", value="csv")
+    ])
+    async def level_export(self, ctx: commands.Context, 形式: str = "jsonl"):
+        await ctx.defer()
+        fmt = "csv" if 形式 == "csv" else "jsonl"
+        await self.flush_xp()
+        with tempfile.TemporaryFile() as fp:
+            count = await export_leveling(self.bot.async_db["Main"].Leveling, ctx.guild.id, fp, fmt)
+            if fp.tell() > ctx.guild.filesize_limit:
+                return await ctx.reply(embed=discord.Embed(title="ファイルが大きすぎるため送信できません。", description="leveltool.py から書き出してください。", color=discord.Color.red()))
+            fp.seek(0)
+            await ctx.reply(embed=discord.Embed(title="レベルデータを書き出しました。", description=f"件数: {count}", color=discord.Color.green()), file=discord.File(fp, filename=f"leveling-{ctx.guild.id}.{fmt}.gz"))
+
+    @level_setting.command(name="import", description="レベルデータをファイルから読み込みます。")
+    @commands.cooldown(1, 60, commands.BucketType.guild)
+    @commands.has_permissions(administrator=True)
+    async def level_import(self, ctx: commands.Context, ファイル: discord.Attachment):
+        await ctx.defer()
+        fmt, compressed = level_transfer_format(ファイル.filename)
+        with tempfile.TemporaryFile() as fp:
+            # 添付ファイルはメモリに載せずに一時ファイルへ流し込む
+            async with self.bot.http_session.get(ファイル.url) as resp:
+                if resp.status != 200:
+                    return await ctx.reply(embed=discord.Embed(title="ファイルをダウンロードできませんでした。", color=discord.Color.red()))
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    fp.write(chunk)
+            fp.seek(0)
+            await self.flush_xp()
+            try:
+                count = await import_leveling(self.bot.async_db["Main"].Leveling, ctx.guild.id, fp, fmt, compressed)
+            except (ValueError, KeyError, OSError, csv.Error) as e:
+                return await ctx.reply(embed=discord.Embed(title="ファイルの形式が正しくありません。", description=f"{e}", color=discord.Color.red()))
+            finally:
+                self.forget_guild_xp(ctx.guild.id)
+        return await ctx.reply(embed=discord.Embed(title="レベルデータを読み込みました。", description=f"件数: {count}", color=discord.Color.green()))
+
     @level_setting.command(name="rewards", description="レベルアップ時のご褒美をリスト化します。")
     @commands.cooldown(2, 10, commands.BucketType.guild)
     async def level_rewards(self, ctx: commands.Context):
@@ -337,19 +1041,51 @@ class LevelCog(commands.Cog):
             return await ctx.reply(embed=discord.Embed(title="レベルは無効です。", color=discord.Color.red()))
         if not enabled:
             return await ctx.reply(embed=discord.Embed(title="レベルは無効です。", color=discord.Color.red()))
-        db = self.bot.async_db["Main"].LevelingUpRole
-        roles_cursor = db.find({"Guild": ctx.guild.id})
-        roles_list = await roles_cursor.to_list(length=None)
-        
+        settings = await self.get_settings(ctx.guild)
         description_lines = []
-        for r in roles_list:
-            role_id = r.get("Role", 0)
+        for level, role_id in settings["roles"]:
             role = ctx.guild.get_role(role_id)
             role_name = role.name if role else "不明なロール"
-            description_lines.append(f"{r.get("Level", "?")}. {role_name}")
+            description_lines.append(f"{level}. {role_name}")
+        if not description_lines:
+            description_lines.append("ご褒美ロールはありません。")
 
         await ctx.reply(embed=discord.Embed(title="レベルアップ時のご褒美リスト", color=discord.Color.yellow()).add_field(name="ご褒美ロール", value=f"\n".join(description_lines)))
 
+    async def get_ranking_page(self, guild_id: int, page: int):
+        now = time.monotonic()
+        cached = self.ranking_cache.get((guild_id, page))
+        if cached and cached[0] > now:
+            return cached[1]
+        if page == 0:
+            # 上位ページは書き込み待ちのXPも反映しておく
+            await self.flush_xp()
+        db = self.bot.async_db["Main"].Leveling
+        docs = await db.find({"Guild": guild_id}, {"_id": False}).sort(RANKING_SORT).skip(page * RANKING_PAGE_SIZE).limit(RANKING_PAGE_SIZE).to_list(length=RANKING_PAGE_SIZE)
+        if len(self.ranking_cache) >= RANKING_CACHE_MAX:
+            self.ranking_cache = {k: v for k, v in self.ranking_cache.items() if v[0] > now}
+        self.ranking_cache[(guild_id, page)] = (now + RANKING_CACHE_TTL, docs)
+        return docs
+
+    async def get_ranking_pages(self, guild_id: int):
+        now = time.monotonic()
+        cached = self.ranking_cache.get((guild_id, None))
+        if cached and cached[0] > now:
+            return cached[1]
+        total = await self.bot.async_db["Main"].Leveling.count_documents({"Guild": guild_id})
+        pages = max((total + RANKING_PAGE_SIZE - 1) // RANKING_PAGE_SIZE, 1)
+        self.ranking_cache[(guild_id, None)] = (now + RANKING_CACHE_TTL, pages)
+        return pages
+
+    async def ranking_embed(self, guild: discord.Guild, page: int, pages: int):
+        top_users = await self.get_ranking_page(guild.id, page)
+        msg = ""
+        for index, user_data in enumerate(top_users, start=page * RANKING_PAGE_SIZE + 1):
+            member = self.bot.get_user(user_data["User"])
+            username = f"{member.display_name}" if member else f"Unknown ({user_data['User']})"
+            msg += f"{index}.**{username}** - {user_data['Level']}レベル ({user_data.get('XP', 0)}XP)\n"
+        return discord.Embed(title="このサーバーでのランキング", description=msg or "まだ誰もいません。", color=discord.Color.yellow()).set_footer(text=f"{page + 1}/{pages}ページ")
+
     @level_setting.command(name="ranking", description="レベルのランキングを取得します。")
     @commands.cooldown(2, 10, commands.BucketType.guild)
     async def level_ranking(self, ctx: commands.Context):
@@ -360,14 +1096,27 @@ class LevelCog(commands.Cog):
             return await ctx.reply(embed=discord.Embed(title="レベルは無効です。", color=discord.Color.red()))
         if not enabled:
             return await ctx.reply(embed=discord.Embed(title="レベルは無効です。", color=discord.Color.red()))
-        db = self.bot.async_db["Main"].Leveling
-        top_users = await db.find({"Guild": ctx.guild.id}).sort("Level", -1).limit(5).to_list(length=5)
-        msg = ""
-        for index, user_data in enumerate(top_users, start=1):
-            member = self.bot.get_user(user_data["User"])
-            username = f"{member.display_name}" if member else f"Unknown ({user_data["User"]})"
-            msg += f"{index}.**{username}** - {user_data["Level"]}レベル\n"
-        return await ctx.reply(embed=discord.Embed(title="このサーバーでのランキング", description=msg, color=discord.Color.yellow()))
+        pages = await self.get_ranking_pages(ctx.guild.id)
+        embed = await self.ranking_embed(ctx.guild, 0, pages)
+        return await ctx.reply(embed=embed, view=PagedView(ctx, 0, pages, lambda page: self.ranking_embed(ctx.guild, page, pages)))
+
+    @level_setting.command(name="rank", description="自分の順位を見ます。")
+    @commands.cooldown(2, 10, commands.BucketType.user)
+    async def level_rank(self, ctx: commands.Context):
+        await ctx.defer()
+        try:
+            enabled = await self.check_level_enabled(ctx.guild)
+        except:
+            return await ctx.reply(embed=discord.Embed(title="レベルは無効です。", color=discord.Color.red()))
+        if not enabled:
+            return await ctx.reply(embed=discord.Embed(title="レベルは無効です。", color=discord.Color.red()))
+        await self.flush_xp()
+        before, state = await self.grant_xp(ctx.guild.id, ctx.author.id, upsert=False)
+        if state is None:
+            return await ctx.reply(embed=discord.Embed(title="まだランキングに載っていません。", color=discord.Color.red()))
+        lv, xp = state
+        rank = await self.get_rank(ctx.guild.id, ctx.author.id, lv, xp)
+        return await ctx.reply(embed=discord.Embed(title=f"`{ctx.author.name}`の順位", description=f"順位: 「{rank}位」\nレベル: 「{lv}レベル」\nXP: 「{xp}XP」", color=discord.Color.yellow()))
 
 async def setup(bot):
     await bot.add_cog(LevelCog(bot))
\ No newline at end of file
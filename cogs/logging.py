@@ -1,4 +1,4 @@
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
 import discord
 import traceback
@@ -6,128 +6,541 @@ import sys
 import logging
 import random
 import datetime
+import re
 import time
 import asyncio
-from discord import Webhook
-import aiohttp
+import zlib
+import tempfile
+from collections import Counter, OrderedDict, deque, namedtuple
+from utils import GuildCache, PagedView
+
+LOG_QUEUE_SIZE = 200            # サーバーごとに溜めておけるログの数
+LOG_OVERFLOW_POLICY = "summarize"  # 溢れたとき: "summarize" は新しいログを、"drop_oldest" は古いログを捨てる
+LOG_BATCH_SIZE = 10             # 1回の送信にまとめる埋め込みの数 (Discordの上限)
+LOG_BATCH_CHARS = 6000          # 1回の送信に入る埋め込みの合計文字数 (Discordの上限)
+LOG_LINGER = 1.0                # 最初のログから送信までまとめて待つ秒数
+LOG_RETRY_AFTER = 5.0           # 429の待ち時間が分からないときに待つ秒数
+LOG_FLUSH_TIMEOUT = 10          # 終了時に送信しきるまで待つ最大秒数
+LOG_CONFIG_CACHE_SIZE = 10000   # 保持するサーバーごとのログ設定の数
+LOG_CONFIG_TTL = 300            # 他のプロセスがDBを書き換えた場合に備えて設定を読み直す秒数
+EVENT_LOG_TTL = 60 * 60 * 24 * 30  # EventLogを残す秒数 (TTLインデックスで消える)
+EVENT_LOG_BATCH = 500           # この数が溜まったらすぐに書き込む
+EVENT_LOG_FLUSH_INTERVAL = 5    # 溜まったEventLogを書き込む間隔 (秒)
+EVENT_LOG_BUFFER_MAX = 20000    # 書き込みに失敗し続けたときに溜めておく最大数
+EVENT_LOG_TEXT_MAX = 1000       # EventLogに保存する本文の最大文字数
+MESSAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024  # メッセージ内容キャッシュ全体の上限
+MESSAGE_CACHE_PER_GUILD = 5000  # サーバーごとに覚えておくメッセージの数
+MESSAGE_CACHE_COMPRESS = True   # 長いメッセージをzlibで圧縮して保持する
+MESSAGE_CACHE_COMPRESS_MIN = 128  # 圧縮するメッセージの最小バイト数
+MESSAGE_CACHE_ENTRY_OVERHEAD = 200  # 1件あたりのPythonオブジェクト分の見積もり (バイト)
+PURGE_REPORT_LINGER = 3.0       # 一括削除が続く間はまとめて1つの報告にする (秒)
+PURGE_TRANSCRIPT_SPOOL = 1024 * 1024  # これを超えた削除記録はメモリではなく一時ファイルに書く
+LOG_EDIT_FRESHNESS = 60         # 編集前の内容が分からないとき、この秒数以内に編集されたものだけをログにする
+LOG_SEARCH_PAGE_SIZE = 10
+LOG_SEARCH_MAX_DAYS = 365
+
+class LogQueue:
+    """サーバー1つ分の送信待ちログ"""
+    def __init__(self, url: str):
+        self.url = url
+        self.embeds = deque()
+        self.dropped = Counter()  # 捨てたログのタイトル: 件数
+        self.worker = None
+
+    def take_batch(self):
+        batch = [self.embeds.popleft()]
+        chars = len(batch[0])
+        while self.embeds and len(batch) < LOG_BATCH_SIZE and chars + len(self.embeds[0]) <= LOG_BATCH_CHARS:
+            chars += len(self.embeds[0])
+            batch.append(self.embeds.popleft())
+        return batch
+
+    def take_summary(self):
+        lines = [f"他に{count}件: {title}" for title, count in self.dropped.most_common(20)]
+        self.dropped.clear()
+        return [discord.Embed(title="<:idea:1367052508396130335> ログが多すぎるため一部を省略しました", description="\n".join(lines), color=discord.Color.orange())]
+
+CachedMessage = namedtuple("CachedMessage", ["id", "guild_id", "channel_id", "author_id", "author_name", "avatar_url", "content"])
+
+class MessageContentCache:
+    """ログに必要な項目だけを持つメッセージのキャッシュ (サーバーごとの件数と全体のバイト数で制限)"""
+    def __init__(self, max_bytes: int = MESSAGE_CACHE_MAX_BYTES, per_guild: int = MESSAGE_CACHE_PER_GUILD, compress: bool = MESSAGE_CACHE_COMPRESS):
+        self.max_bytes = max_bytes
+        self.per_guild = per_guild
+        self.compress = compress
+        self.messages = OrderedDict()  # message_id: (guild_id, channel_id, author_id, author_name, avatar_url, data, compressed, size)
+        self.guilds = {}  # guild_id: OrderedDict(message_id: None) 古い順
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def encode(self, content: str):
+        data = content.encode("utf-8")
+        if self.compress and len(data) >= MESSAGE_CACHE_COMPRESS_MIN:
+            packed = zlib.compress(data)
+            if len(packed) < len(data):
+                return packed, True
+        return data, False
+
+    def put(self, message: discord.Message):
+        author = message.author
+        avatar_url = author.avatar.url if author.avatar else author.default_avatar.url
+        self.store(message.id, message.guild.id, message.channel.id, author.id, author.name, avatar_url, message.content)
+
+    def store(self, message_id: int, guild_id: int, channel_id: int, author_id: int, author_name: str, avatar_url: str, content: str):
+        self.remove(message_id)
+        data, compressed = self.encode(content)
+        size = len(data) + len(author_name) + len(avatar_url) + MESSAGE_CACHE_ENTRY_OVERHEAD
+        self.messages[message_id] = (guild_id, channel_id, author_id, author_name, avatar_url, data, compressed, size)
+        self.bytes += size
+        ids = self.guilds.setdefault(guild_id, OrderedDict())
+        ids[message_id] = None
+        while len(ids) > self.per_guild:
+            self.remove(next(iter(ids)))
+            self.evictions += 1
+        while self.bytes > self.max_bytes and self.messages:
+            self.remove(next(iter(self.messages)))
+            self.evictions += 1
+
+    def remove(self, message_id: int):
+        entry = self.messages.pop(message_id, None)
+        if entry is None:
+            return None
+        self.bytes -= entry[7]
+        ids = self.guilds.get(entry[0])
+        if ids is not None:
+            ids.pop(message_id, None)
+            if not ids:
+                del self.guilds[entry[0]]
+        return entry
+
+    def decode(self, message_id: int, entry: tuple):
+        guild_id, channel_id, author_id, author_name, avatar_url, data, compressed, _ = entry
+        content = (zlib.decompress(data) if compressed else data).decode("utf-8")
+        return CachedMessage(message_id, guild_id, channel_id, author_id, author_name, avatar_url, content)
+
+    def get(self, message_id: int):
+        entry = self.messages.get(message_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.decode(message_id, entry)
+
+    def pop(self, message_id: int):
+        entry = self.remove(message_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.decode(message_id, entry)
+
+    def drop_guild(self, guild_id: int):
+        for message_id in list(self.guilds.get(guild_id, ())):
+            self.remove(message_id)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.messages),
+            "guilds": len(self.guilds),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+class PurgeReport:
+    """チャンネル1つ分の一括削除の報告。削除されたメッセージは届いた順に記録へ書き出す"""
+    def __init__(self, url: str):
+        self.url = url
+        self.transcript = tempfile.SpooledTemporaryFile(max_size=PURGE_TRANSCRIPT_SPOOL)
+        self.deleted = 0
+        self.cached = 0
+        self.authors = Counter()  # 投稿者名: 件数
+        self.preview = []  # EventLogの検索用に残す本文の先頭
+        self.preview_chars = 0
+        self.last = time.monotonic()
+        self.task = None
+
+    def add(self, message_id: int, cached):
+        created = discord.utils.snowflake_time(message_id).strftime("%Y-%m-%d %H:%M:%S")
+        self.deleted += 1
+        self.last = time.monotonic()
+        if cached is None:
+            self.transcript.write(f"[{created}] mid:{message_id} (内容はキャッシュにありませんでした)\n\n".encode("utf-8"))
+            return
+        if isinstance(cached, discord.Message):
+            author_name, author_id = cached.author.name, cached.author.id
+        else:
+            author_name, author_id = cached.author_name, cached.author_id
+        self.cached += 1
+        self.authors[author_name] += 1
+        self.transcript.write(f"[{created}] {author_name} (uid:{author_id}) mid:{message_id}\n{cached.content}\n\n".encode("utf-8"))
+        if self.preview_chars < EVENT_LOG_TEXT_MAX and cached.content:
+            self.preview.append(cached.content)
+            self.preview_chars += len(cached.content) + 1
+
+    def embed(self, channel_id: int):
+        authors = "\n".join(f"{name}: {count}件" for name, count in self.authors.most_common(10)) or "不明"
+        return discord.Embed(title="<:Minus:1367039494322262096> メッセージが一括削除されました", description=f"チャンネル: <#{channel_id}>\n削除されたメッセージ: {self.deleted}件\n内容が分かったメッセージ: {self.cached}件\n投稿者:\n{authors}", color=discord.Color.red()).set_footer(text=f"cid:{channel_id}")
 
 class LoggingCog(commands.Cog):
+    mongo_indexes = {
+        "EventLoggingChannel": [([("Guild", 1)], {})],
+        "EventLog": [
+            ([("Guild", 1), ("Type", 1), ("Time", -1)], {}),
+            ([("Guild", 1), ("User", 1), ("Time", -1)], {}),
+            ([("Guild", 1), ("Channel", 1), ("Time", -1)], {}),
+            ([("Guild", 1), ("Time", -1)], {}),
+            ([("Time", 1)], {"expireAfterSeconds": EVENT_LOG_TTL}),
+        ],
+    }
+    mongo_queries = {
+        "EventLoggingChannel": [("Guild",), ("Guild", "Channel")],
+        "EventLog": [("Guild", "Time"), ("Guild", "Type", "Time"), ("Guild", "User", "Time"), ("Guild", "Channel", "Time")],
+    }
+
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.log_queues = {}  # guild_id: LogQueue
+        self.log_stats = Counter()
+        self.config_cache = GuildCache(LOG_CONFIG_CACHE_SIZE, LOG_CONFIG_TTL)
+        self.event_buffer = []  # 書き込み待ちのEventLog
+        self.event_flush_lock = asyncio.Lock()
+        self.event_flush_task = None
+        self.message_cache = MessageContentCache()
+        self.purge_reports = {}  # (guild_id, channel_id): PurgeReport
         print(f"init -> LoggingCog")
 
-    async def get_logging_webhook(self, guild: discord.Guild):
+    async def cog_load(self):
+        self.flush_events_loop.start()
+
+    async def cog_unload(self):
+        self.flush_events_loop.cancel()
+        await self.flush_pending()
+        for queue in self.log_queues.values():
+            if queue.worker:
+                queue.worker.cancel()
+        for report in self.purge_reports.values():
+            if report.task:
+                report.task.cancel()
+            report.transcript.close()
+
+    async def flush_pending(self):
+        workers = [q.worker for q in self.log_queues.values() if q.worker and not q.worker.done()]
+        workers += [r.task for r in self.purge_reports.values() if r.task and not r.task.done()]
+        if workers:
+            await asyncio.wait(workers, timeout=LOG_FLUSH_TIMEOUT)
+        await self.flush_events()
+
+    @tasks.loop(seconds=EVENT_LOG_FLUSH_INTERVAL)
+    async def flush_events_loop(self):
+        await self.flush_events()
+
+    async def flush_events(self):
+        async with self.event_flush_lock:
+            if not self.event_buffer:
+                return
+            events, self.event_buffer = self.event_buffer, []
+            try:
+                await self.bot.async_db["Main"].EventLog.insert_many(events, ordered=False)
+                self.log_stats["events_written"] += len(events)
+            except Exception as e:
+                print(f"Error in flush_events: {e}")
+                # 次の書き込みでやり直す (溜まりすぎたら古いものから捨てる)
+                self.event_buffer[:0] = events
+                overflow = len(self.event_buffer) - EVENT_LOG_BUFFER_MAX
+                if overflow > 0:
+                    del self.event_buffer[:overflow]
+                    self.log_stats["events_dropped"] += overflow
+
+    def record_event(self, guild_id: int, event_type: str, embed: discord.Embed, user: int = None, channel: int = None, text: str = None):
+        text = embed.description if text is None else text
+        self.event_buffer.append({
+            "Guild": guild_id,
+            "Type": event_type,
+            "User": user,
+            "Channel": channel,
+            "Title": embed.title,
+            "Author": embed.author.name,
+            "Text": (text or "")[:EVENT_LOG_TEXT_MAX],
+            "Time": datetime.datetime.now(datetime.timezone.utc),
+        })
+        if len(self.event_buffer) >= EVENT_LOG_BATCH and (self.event_flush_task is None or self.event_flush_task.done()):
+            self.event_flush_task = asyncio.create_task(self.flush_events())
+
+    def cache_stats(self):
+        return {
+            "logging_config": self.config_cache.stats(),
+            "logging_messages": self.message_cache.stats(),
+            "logging_queue": {
+                "guilds": len(self.log_queues),
+                "queued": sum(len(q.embeds) for q in self.log_queues.values()),
+                "sent_messages": self.log_stats["sent_messages"],
+                "sent_embeds": self.log_stats["sent_embeds"],
+                "dropped": self.log_stats["dropped"],
+                "rate_limited": self.log_stats["rate_limited"],
+                "purge_reports": self.log_stats["purge_reports"],
+            },
+            "logging_events": {
+                "buffered": len(self.event_buffer),
+                "written": self.log_stats["events_written"],
+                "dropped": self.log_stats["events_dropped"],
+            },
+        }
+
+    # ログはすぐには送らず、サーバーごとに溜めてまとめて送る (検索用にEventLogにも残す)
+    def dispatch_log(self, guild_id: int, url: str, embed: discord.Embed, event_type: str, user: int = None, channel: int = None, text: str = None):
+        self.record_event(guild_id, event_type, embed, user=user, channel=channel, text=text)
+        queue = self.log_queues.get(guild_id)
+        if queue is None:
+            queue = self.log_queues[guild_id] = LogQueue(url)
+        queue.url = url
+        if len(queue.embeds) >= LOG_QUEUE_SIZE:
+            self.log_stats["dropped"] += 1
+            if LOG_OVERFLOW_POLICY == "drop_oldest":
+                queue.dropped[queue.embeds.popleft().title] += 1
+                queue.embeds.append(embed)
+            else:
+                queue.dropped[embed.title] += 1
+        else:
+            queue.embeds.append(embed)
+        if queue.worker is None or queue.worker.done():
+            queue.worker = asyncio.create_task(self.log_worker(guild_id, queue))
+
+    async def log_worker(self, guild_id: int, queue: LogQueue):
+        await asyncio.sleep(LOG_LINGER)
+        while queue.embeds or queue.dropped:
+            # 省略したログの件数は溜まっていたログを送り切ってから送る
+            batch = queue.take_batch() if queue.embeds else queue.take_summary()
+            url = queue.url
+            bucket = self.bot.webhook_bucket(url)
+            await bucket.acquire()
+            try:
+                await self.bot.get_webhook(url).send(avatar_url=self.bot.user.avatar.url, embeds=batch)
+                self.log_stats["sent_messages"] += 1
+                self.log_stats["sent_embeds"] += len(batch)
+            except discord.NotFound:
+                # Webhookが消されている
+                print(f"Logging webhook not found: guild={guild_id}")
+                self.config_cache.invalidate(guild_id)
+                self.log_stats["dropped"] += len(batch) + len(queue.embeds)
+                queue.embeds.clear()
+                queue.dropped.clear()
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    self.log_stats["rate_limited"] += 1
+                    bucket.limited(getattr(e, "retry_after", None) or LOG_RETRY_AFTER)
+                    queue.embeds.extendleft(reversed(batch))
+                    continue
+                print(f"Error in log_worker: {e}")
+                self.log_stats["dropped"] += len(batch)
+            except Exception as e:
+                print(f"Error in log_worker: {e}")
+                self.log_stats["dropped"] += len(batch)
+        if self.log_queues.get(guild_id) is queue:
+            del self.log_queues[guild_id]
+
+    async def load_logging_config(self, guild_id: int):
         db = self.bot.async_db["Main"].EventLoggingChannel
+        dbfind = await db.find_one({"Guild": guild_id}, {"_id": False})
+        # 未設定のサーバーも空の設定としてキャッシュする
+        return dbfind or {}
+
+    async def get_logging_config(self, guild: discord.Guild):
+        # 同じサーバーの読み込みが同時に走らないようにする
+        return await self.config_cache.get_or_load(guild.id, lambda: self.load_logging_config(guild.id))
+
+    async def get_logging_webhook(self, guild: discord.Guild):
         try:
-            dbfind = await db.find_one({"Guild": guild.id}, {"_id": False})
+            config = await self.get_logging_config(guild)
         except:
             return None
-        if dbfind is None:
-            return None
-        return dbfind.get("Webhook", None)
+        return config.get("Webhook", None)
     
     async def get_logging_channel(self, guild: discord.Guild):
-        db = self.bot.async_db["Main"].EventLoggingChannel
         try:
-            dbfind = await db.find_one({"Guild": guild.id}, {"_id": False})
+            config = await self.get_logging_config(guild)
         except:
             return None
-        if dbfind is None:
-            return None
-        return self.bot.get_channel(dbfind.get("Channel", None))
+        return self.bot.get_channel(config.get("Channel", None))
 
-    @commands.Cog.listener("on_message_delete")
-    async def on_message_delete_log(self, message: discord.Message):
+    def message_delete_embed(self, message_id: int, channel_id: int, cached):
+        # cached は discord.Message か CachedMessage (どちらもなければ内容は分からない)
+        if cached is None:
+            return discord.Embed(title="<:Minus:1367039494322262096> メッセージが削除されました", description="(内容はキャッシュにありませんでした)", color=discord.Color.red()).set_footer(text=f"mid:{message_id} cid:{channel_id}")
+        if isinstance(cached, discord.Message):
+            author = {"name": f"{cached.author.name}", "icon_url": cached.author.avatar.url if cached.author.avatar else cached.author.default_avatar.url}
+        else:
+            author = {"name": f"{cached.author_name}", "icon_url": cached.avatar_url}
+        return discord.Embed(title="<:Minus:1367039494322262096> メッセージが削除されました", description=f"{cached.content}", color=discord.Color.red()).set_footer(text=f"mid:{message_id}").set_author(**author)
+
+    @commands.Cog.listener("on_message")
+    async def on_message_cache(self, message: discord.Message):
+        if message.guild is None:
+            return
         try:
+            # ログが有効なサーバーのメッセージだけ覚えておく
             wh = await self.get_logging_webhook(message.guild)
             if not wh:
                 return
-            async with aiohttp.ClientSession() as session:
-                webhook_ = Webhook.from_url(wh, session=session)
-                await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:Minus:1367039494322262096> メッセージが削除されました", description=f"{message.content}", color=discord.Color.red()).set_footer(text=f"mid:{message.id}").set_author(name=f"{message.author.name}", icon_url=message.author.avatar.url if message.author.avatar else message.author.default_avatar.url))
-        except Exception as e:
+            self.message_cache.put(message)
+        except:
             return
 
-    @commands.Cog.listener("on_member_ban")
-    async def on_member_ban_log(self, guild: discord.Guild, member: discord.Member):
+    @commands.Cog.listener("on_guild_remove")
+    async def on_guild_remove_cache(self, guild: discord.Guild):
+        self.message_cache.drop_guild(guild.id)
+
+    @commands.Cog.listener("on_raw_message_delete")
+    async def on_message_delete_log(self, payload: discord.RawMessageDeleteEvent):
         try:
+            entry = self.message_cache.pop(payload.message_id)
+            if payload.guild_id is None:
+                return
+            guild = self.bot.get_guild(payload.guild_id)
+            if guild is None:
+                return
             wh = await self.get_logging_webhook(guild)
             if not wh:
                 return
-            async with aiohttp.ClientSession() as session:
-                webhook_ = Webhook.from_url(wh, session=session)
-                await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:Minus:1367039494322262096> メンバーがBANされました", description=f"{member.mention}\nメンバーがBANされました: {datetime.datetime.now()}", color=discord.Color.red()).set_footer(text=f"uid:{member.id}").set_author(name=f"{member.name}", icon_url=member.avatar.url if member.avatar else member.default_avatar.url))
-        except:
+            cached = payload.cached_message or entry
+            embed = self.message_delete_embed(payload.message_id, payload.channel_id, cached)
+            if cached is None:
+                return self.dispatch_log(guild.id, wh, embed, "delete", channel=payload.channel_id, text="")
+            user = cached.author.id if isinstance(cached, discord.Message) else cached.author_id
+            self.dispatch_log(guild.id, wh, embed, "delete", user=user, channel=payload.channel_id)
+        except Exception as e:
             return
-        
-    @commands.Cog.listener("on_member_update")
-    async def on_member_update_log(self, before: discord.Member, after: discord.Member):
+
+    @commands.Cog.listener("on_raw_bulk_message_delete")
+    async def on_bulk_message_delete_log(self, payload: discord.RawBulkMessageDeleteEvent):
         try:
-            if before.display_name == after.display_name:
+            entries = {message_id: self.message_cache.pop(message_id) for message_id in payload.message_ids}
+            if payload.guild_id is None:
                 return
-            wh = await self.get_logging_webhook(after.guild)
+            guild = self.bot.get_guild(payload.guild_id)
+            if guild is None:
+                return
+            wh = await self.get_logging_webhook(guild)
             if not wh:
                 return
-            async with aiohttp.ClientSession() as session:
-                webhook_ = Webhook.from_url(wh, session=session)
-                await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:Edit:1367039517868953600> メンバーが編集されました", description=f"編集前の名前: {before.display_name}\nメンバーの編集時間: {datetime.datetime.now()}\n編集後の名前: {after.display_name}", color=discord.Color.yellow()).set_footer(text=f"uid:{after.id}").set_author(name=f"{after.name}", icon_url=after.avatar.url if after.avatar else after.default_avatar.url))
-        except:
+            for message in payload.cached_messages:
+                entries[message.id] = message
+            # 100件ずつ届く一括削除を、チャンネルごとに1つの報告にまとめる
+            key = (guild.id, payload.channel_id)
+            report = self.purge_reports.get(key)
+            if report is None:
+                report = self.purge_reports[key] = PurgeReport(wh)
+            for message_id in sorted(entries):
+                report.add(message_id, entries[message_id])
+            if report.task is None:
+                report.task = asyncio.create_task(self.send_purge_report(key, report))
+        except Exception as e:
             return
 
-    @commands.Cog.listener("on_member_update")
-    async def on_member_update_timeout_log(self, before: discord.Member, after: discord.Member):
+    async def send_purge_report(self, key: tuple, report: PurgeReport):
+        guild_id, channel_id = key
         try:
-            wh = await self.get_logging_webhook(after.guild)
+            while True:
+                wait = report.last + PURGE_REPORT_LINGER - time.monotonic()
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.purge_reports.get(key) is report:
+                del self.purge_reports[key]
+            embed = report.embed(channel_id)
+            self.record_event(guild_id, "bulk_delete", embed, channel=channel_id, text="\n".join(report.preview))
+            report.transcript.seek(0)
+            file = discord.File(report.transcript, filename=f"deleted-messages-{channel_id}.txt")
+            await self.bot.webhook_bucket(report.url).acquire()
+            await self.bot.get_webhook(report.url).send(avatar_url=self.bot.user.avatar.url, embed=embed, file=file)
+            self.log_stats["sent_messages"] += 1
+            self.log_stats["sent_embeds"] += 1
+            self.log_stats["purge_reports"] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error in send_purge_report: {e}")
+        finally:
+            report.transcript.close()
+
+    @commands.Cog.listener("on_member_ban")
+    async def on_member_ban_log(self, guild: discord.Guild, member: discord.Member):
+        try:
+            wh = await self.get_logging_webhook(guild)
             if not wh:
                 return
-
-            if before.timed_out_until is None and after.timed_out_until is not None:
-                async with aiohttp.ClientSession() as session:
-                    webhook_ = Webhook.from_url(wh, session=session)
-                    await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:Plus:1367039505865113670> メンバーがタイムアウトされました。", description=f"メンバー: {after.mention}", color=discord.Color.green()).set_footer(text=f"uid:{after.id}").set_author(name=f"{after.name}", icon_url=after.avatar.url if after.avatar else after.default_avatar.url))
+            self.dispatch_log(guild.id, wh, discord.Embed(title="<:Minus:1367039494322262096> メンバーがBANされました", description=f"{member.mention}\nメンバーがBANされました: {datetime.datetime.now()}", color=discord.Color.red()).set_footer(text=f"uid:{member.id}").set_author(name=f"{member.name}", icon_url=member.avatar.url if member.avatar else member.default_avatar.url), "ban", user=member.id)
         except:
             return
-
+        
     @commands.Cog.listener("on_member_update")
-    async def on_member_update_role_log(self, before: discord.Member, after: discord.Member):
+    async def on_member_update_log(self, before: discord.Member, after: discord.Member):
         try:
-            before_roles = set(before.roles)
-            after_roles = set(after.roles)
-
-            added_roles = after_roles - before_roles
-            removed_roles = before_roles - after_roles
+            # 先に差分を計算し、何も変わっていなければDBもWebhookも使わない
+            renamed = before.display_name != after.display_name
+            timed_out = before.timed_out_until is None and after.timed_out_until is not None
+            before_ids = {r.id for r in before.roles}
+            after_ids = {r.id for r in after.roles}
+            added_roles = [r for r in after.roles if r.id not in before_ids]
+            removed_roles = [r for r in before.roles if r.id not in after_ids]
+            if not (renamed or timed_out or added_roles or removed_roles):
+                return
 
             wh = await self.get_logging_webhook(after.guild)
             if not wh:
                 return
 
+            author = {"name": f"{after.name}", "icon_url": after.avatar.url if after.avatar else after.default_avatar.url}
+            if renamed:
+                self.dispatch_log(after.guild.id, wh, discord.Embed(title="<:Edit:1367039517868953600> メンバーが編集されました", description=f"編集前の名前: {before.display_name}\nメンバーの編集時間: {datetime.datetime.now()}\n編集後の名前: {after.display_name}", color=discord.Color.yellow()).set_footer(text=f"uid:{after.id}").set_author(**author), "nick", user=after.id, text=f"{before.display_name} -> {after.display_name}")
+
+            if timed_out:
+                self.dispatch_log(after.guild.id, wh, discord.Embed(title="<:Plus:1367039505865113670> メンバーがタイムアウトされました。", description=f"メンバー: {after.mention}", color=discord.Color.green()).set_footer(text=f"uid:{after.id}").set_author(**author), "timeout", user=after.id)
+
             if added_roles:
-                async with aiohttp.ClientSession() as session:
-                    webhook_ = Webhook.from_url(wh, session=session)
-                    await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:Plus:1367039505865113670> ロールが追加されました", description=f"メンバー: {after.mention}\nロール: {'\n'.join([rr.mention for rr in added_roles])}", color=discord.Color.green()).set_footer(text=f"uid:{after.id}").set_author(name=f"{after.name}", icon_url=after.avatar.url if after.avatar else after.default_avatar.url))
+                self.dispatch_log(after.guild.id, wh, discord.Embed(title="<:Plus:1367039505865113670> ロールが追加されました", description=f"メンバー: {after.mention}\nロール: {'\n'.join([rr.mention for rr in added_roles])}", color=discord.Color.green()).set_footer(text=f"uid:{after.id}").set_author(**author), "role_add", user=after.id, text=" ".join(rr.name for rr in added_roles))
 
             if removed_roles:
-                async with aiohttp.ClientSession() as session:
-                    webhook_ = Webhook.from_url(wh, session=session)
-                    await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:Minus:1367039494322262096> ロールが削除されました", description=f"メンバー: {after.mention}\nロール: {'\n'.join([rr.mention for rr in removed_roles])}", color=discord.Color.red()).set_footer(text=f"uid:{after.id}").set_author(name=f"{after.name}", icon_url=after.avatar.url if after.avatar else after.default_avatar.url))
+                self.dispatch_log(after.guild.id, wh, discord.Embed(title="<:Minus:1367039494322262096> ロールが削除されました", description=f"メンバー: {after.mention}\nロール: {'\n'.join([rr.mention for rr in removed_roles])}", color=discord.Color.red()).set_footer(text=f"uid:{after.id}").set_author(**author), "role_remove", user=after.id, text=" ".join(rr.name for rr in removed_roles))
         except:
             return
 
-    @commands.Cog.listener("on_message_edit")
-    async def on_message_edit_log(self, before: discord.Message, after: discord.Message):
+    @commands.Cog.listener("on_raw_message_edit")
+    async def on_message_edit_log(self, payload: discord.RawMessageUpdateEvent):
         try:
+            after = payload.message
+            if after.guild is None:
+                return
+            if payload.cached_message is not None:
+                before_content = payload.cached_message.content
+            else:
+                entry = self.message_cache.get(after.id)
+                before_content = entry.content if entry else None
+            if after.id in self.message_cache.messages:
+                self.message_cache.put(after)
             if after.author.id == self.bot.user.id:
                 return
             if after.content == "":
                 return
-            if before.content == after.content:
+            if before_content == after.content:
                 return
+            if before_content is None:
+                # ピン留めや埋め込みの展開でも届くので、edited_timestampが新しいものだけを編集として扱う
+                if after.edited_at is None:
+                    return
+                if (discord.utils.utcnow() - after.edited_at).total_seconds() > LOG_EDIT_FRESHNESS:
+                    return
             wh = await self.get_logging_webhook(after.guild)
             if not wh:
                 return
-            async with aiohttp.ClientSession() as session:
-                webhook_ = Webhook.from_url(wh, session=session)
-                await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:Edit:1367039517868953600> メッセージが編集されました", description=f"編集前:\n{before.content}\n編集後:\n{after.content}", color=discord.Color.yellow()).set_footer(text=f"mid:{after.id}").set_author(name=f"{after.author.name}", icon_url=after.author.avatar.url if after.author.avatar else after.author.default_avatar.url))
+            before_text = "(編集前の内容はキャッシュにありませんでした)" if before_content is None else before_content
+            self.dispatch_log(after.guild.id, wh, discord.Embed(title="<:Edit:1367039517868953600> メッセージが編集されました", description=f"編集前:\n{before_text}\n編集後:\n{after.content}", color=discord.Color.yellow()).set_footer(text=f"mid:{after.id}").set_author(name=f"{after.author.name}", icon_url=after.author.avatar.url if after.author.avatar else after.author.default_avatar.url), "edit", user=after.author.id, channel=after.channel.id, text=f"{before_content or ''}\n{after.content}")
         except:
             return
         
@@ -137,9 +550,7 @@ class LoggingCog(commands.Cog):
             wh = await self.get_logging_webhook(channel.guild)
             if not wh:
                 return
-            async with aiohttp.ClientSession() as session:
-                webhook_ = Webhook.from_url(wh, session=session)
-                await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:Plus:1367039505865113670> チャンネルが作成されました", description=f"名前: {channel.name}\n作成時間: {channel.created_at}", color=discord.Color.green()).set_footer(text=f"cid:{channel.id}"))
+            self.dispatch_log(channel.guild.id, wh, discord.Embed(title="<:Plus:1367039505865113670> チャンネルが作成されました", description=f"名前: {channel.name}\n作成時間: {channel.created_at}", color=discord.Color.green()).set_footer(text=f"cid:{channel.id}"), "channel_create", channel=channel.id, text=channel.name)
         except:
             return
         
@@ -149,9 +560,7 @@ class LoggingCog(commands.Cog):
             wh = await self.get_logging_webhook(channel.guild)
             if not wh:
                 return
-            async with aiohttp.ClientSession() as session:
-                webhook_ = Webhook.from_url(wh, session=session)
-                await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:Minus:1367039494322262096> チャンネルが削除されました", description=f"名前: {channel.name}", color=discord.Color.red()).set_footer(text=f"cid:{channel.id}"))
+            self.dispatch_log(channel.guild.id, wh, discord.Embed(title="<:Minus:1367039494322262096> チャンネルが削除されました", description=f"名前: {channel.name}", color=discord.Color.red()).set_footer(text=f"cid:{channel.id}"), "channel_delete", channel=channel.id, text=channel.name)
         except:
             return
         
@@ -161,9 +570,7 @@ class LoggingCog(commands.Cog):
             wh = await self.get_logging_webhook(invite.guild)
             if not wh:
                 return
-            async with aiohttp.ClientSession() as session:
-                webhook_ = Webhook.from_url(wh, session=session)
-                await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:Plus:1367039505865113670> 招待リンクが作成されました", description=f"チャンネル: {invite.channel.name}\n招待リンク作成時間: {datetime.datetime.now()}\nurl: {invite.url}", color=discord.Color.green()).set_footer(text=f"invid:{invite.id}").set_author(name=f"{invite.inviter.name}", icon_url=invite.inviter.avatar.url if invite.inviter.avatar else invite.inviter.default_avatar.url))
+            self.dispatch_log(invite.guild.id, wh, discord.Embed(title="<:Plus:1367039505865113670> 招待リンクが作成されました", description=f"チャンネル: {invite.channel.name}\n招待リンク作成時間: {datetime.datetime.now()}\nurl: {invite.url}", color=discord.Color.green()).set_footer(text=f"invid:{invite.id}").set_author(name=f"{invite.inviter.name}", icon_url=invite.inviter.avatar.url if invite.inviter.avatar else invite.inviter.default_avatar.url), "invite", user=invite.inviter.id, channel=invite.channel.id, text=invite.url)
         except:
             return
 
@@ -173,9 +580,7 @@ class LoggingCog(commands.Cog):
             wh = await self.get_logging_webhook(role.guild)
             if not wh:
                 return
-            async with aiohttp.ClientSession() as session:
-                webhook_ = Webhook.from_url(wh, session=session)
-                await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:Plus:1367039505865113670> ロールが作成されました", description=f"名前: {role.name}", color=discord.Color.green()).set_footer(text=f"rid:{role.id}"))
+            self.dispatch_log(role.guild.id, wh, discord.Embed(title="<:Plus:1367039505865113670> ロールが作成されました", description=f"名前: {role.name}", color=discord.Color.green()).set_footer(text=f"rid:{role.id}"), "role_create", text=role.name)
         except:
             return
         
@@ -185,9 +590,7 @@ class LoggingCog(commands.Cog):
             wh = await self.get_logging_webhook(role.guild)
             if not wh:
                 return
-            async with aiohttp.ClientSession() as session:
-                webhook_ = Webhook.from_url(wh, session=session)
-                await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:Minus:1367039494322262096> ロールが削除されました", description=f"名前: {role.name}", color=discord.Color.red()).set_footer(text=f"rid:{role.id}"))
+            self.dispatch_log(role.guild.id, wh, discord.Embed(title="<:Minus:1367039494322262096> ロールが削除されました", description=f"名前: {role.name}", color=discord.Color.red()).set_footer(text=f"rid:{role.id}"), "role_delete", text=role.name)
         except:
             return
 
@@ -197,9 +600,7 @@ class LoggingCog(commands.Cog):
             wh = await self.get_logging_webhook(member.guild)
             if not wh:
                 return
-            async with aiohttp.ClientSession() as session:
-                webhook_ = Webhook.from_url(wh, session=session)
-                await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:Plus:1367039505865113670> メンバーが参加しました", description=f"名前: {member.name}\nアカウント作成日: {member.created_at}\n参加時間: {datetime.datetime.now()}", color=discord.Color.green()).set_footer(text=f"mid:{member.id}").set_author(name=f"{member.name}", icon_url=member.avatar.url if member.avatar else member.default_avatar.url))
+            self.dispatch_log(member.guild.id, wh, discord.Embed(title="<:Plus:1367039505865113670> メンバーが参加しました", description=f"名前: {member.name}\nアカウント作成日: {member.created_at}\n参加時間: {datetime.datetime.now()}", color=discord.Color.green()).set_footer(text=f"mid:{member.id}").set_author(name=f"{member.name}", icon_url=member.avatar.url if member.avatar else member.default_avatar.url), "join", user=member.id, text=member.name)
         except:
             return
         
@@ -209,9 +610,7 @@ class LoggingCog(commands.Cog):
             wh = await self.get_logging_webhook(member.guild)
             if not wh:
                 return
-            async with aiohttp.ClientSession() as session:
-                webhook_ = Webhook.from_url(wh, session=session)
-                await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:Minus:1367039494322262096> メンバーが退出しました", description=f"名前: {member.name}\nアカウント作成日: {member.created_at}\n参加時間: {datetime.datetime.now()}", color=discord.Color.red()).set_footer(text=f"mid:{member.id}").set_author(name=f"{member.name}", icon_url=member.avatar.url if member.avatar else member.default_avatar.url))
+            self.dispatch_log(member.guild.id, wh, discord.Embed(title="<:Minus:1367039494322262096> メンバーが退出しました", description=f"名前: {member.name}\nアカウント作成日: {member.created_at}\n参加時間: {datetime.datetime.now()}", color=discord.Color.red()).set_footer(text=f"mid:{member.id}").set_author(name=f"{member.name}", icon_url=member.avatar.url if member.avatar else member.default_avatar.url), "leave", user=member.id, text=member.name)
         except:
             return
 
@@ -226,6 +625,7 @@ class LoggingCog(commands.Cog):
             {"Guild": ctx.guild.id, "Channel": ctx.channel.id, "Webhook": web.url}, 
             upsert=True
         )
+        self.config_cache.invalidate(ctx.guild.id)
         await ctx.reply(embed=discord.Embed(title="<:Success:1362271281302601749> ログをセットアップしました。", color=discord.Color.green()))
 
     @logging_setup.command(name="disable", description="ログを無効化します。")
@@ -234,6 +634,7 @@ class LoggingCog(commands.Cog):
     async def logging_disable(self, ctx: commands.Context):
         db = self.bot.async_db["Main"].EventLoggingChannel
         await db.delete_one({"Guild": ctx.guild.id})
+        self.config_cache.invalidate(ctx.guild.id)
         await ctx.reply(embed=discord.Embed(title="<:Success:1362271281302601749> ログを無効化しました。", color=discord.Color.green()))
 
     @logging_setup.command(name="sendlog", description="ログを送信します")
@@ -243,37 +644,82 @@ class LoggingCog(commands.Cog):
         wh = await self.get_logging_webhook(ctx.guild)
         if not wh:
             return await ctx.reply(embed=discord.Embed(title="<:Error:1362271424227709028> ログを送信できませんでした。", color=discord.Color.red()))
-        async with aiohttp.ClientSession() as session:
-            webhook_ = Webhook.from_url(wh, session=session)
-            await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=discord.Embed(title="<:idea:1367052508396130335> ログが送信されました", description=内容, color=discord.Color.blue()).set_author(name=f"{ctx.author.name}", icon_url=ctx.author.avatar.url if ctx.author.avatar else ctx.author.default_avatar.url))
+        embed = discord.Embed(title="<:idea:1367052508396130335> ログが送信されました", description=内容, color=discord.Color.blue()).set_author(name=f"{ctx.author.name}", icon_url=ctx.author.avatar.url if ctx.author.avatar else ctx.author.default_avatar.url)
+        self.record_event(ctx.guild.id, "custom", embed, user=ctx.author.id, channel=ctx.channel.id)
+        await self.bot.webhook_bucket(wh).acquire()
+        webhook_ = self.bot.get_webhook(wh)
+        await webhook_.send(avatar_url=self.bot.user.avatar.url, embed=embed)
         await ctx.reply(embed=discord.Embed(title="<:Success:1362271281302601749> ログを送信しました。", color=discord.Color.green()))
 
-    @logging_setup.command(name="logsearch", description="最新のログを検索します。")
+    async def logsearch_embed(self, query: dict, page: int, total: int):
+        db = self.bot.async_db["Main"].EventLog
+        pages = max((total + LOG_SEARCH_PAGE_SIZE - 1) // LOG_SEARCH_PAGE_SIZE, 1)
+        events = await db.find(query, {"_id": False}).sort("Time", -1).skip(page * LOG_SEARCH_PAGE_SIZE).limit(LOG_SEARCH_PAGE_SIZE).to_list(LOG_SEARCH_PAGE_SIZE)
+        embed = discord.Embed(title="ログの検索結果", color=discord.Color.green())
+        for event in events:
+            logged_at = event["Time"]
+            if logged_at.tzinfo is None:
+                logged_at = logged_at.replace(tzinfo=datetime.timezone.utc)
+            value = event.get("Text") or "内容なし"
+            if len(value) > 200:
+                value = value[:200] + "..."
+            if event.get("Author"):
+                value = f"{event['Author']}: {value}"
+            if event.get("User"):
+                value += f"\nuid:{event['User']}"
+            if event.get("Channel"):
+                value += f"\ncid:{event['Channel']}"
+            embed.add_field(name=f"{event.get('Title') or event['Type']} ({discord.utils.format_dt(logged_at, 'f')})"[:256], value=value[:1024], inline=False)
+        if not events:
+            embed.description = "見つかりませんでした。"
+        return embed.set_footer(text=f"{page + 1}/{pages}ページ ({total}件)")
+
+    @logging_setup.command(name="logsearch", description="ログを検索します。")
     @commands.cooldown(2, 10, commands.BucketType.guild)
     @commands.has_permissions(administrator=True)
     @app_commands.choices(内容=[
         app_commands.Choice(name='メッセージ削除',value="delete"),
-        app_commands.Choice(name='メンバー参加',value="join")
+        app_commands.Choice(name='メッセージ一括削除',value="bulk_delete"),
+        app_commands.Choice(name='メッセージ編集',value="edit"),
+        app_commands.Choice(name='メンバー参加',value="join"),
+        app_commands.Choice(name='メンバー退出',value="leave"),
+        app_commands.Choice(name='メンバーBAN',value="ban"),
+        app_commands.Choice(name='タイムアウト',value="timeout"),
+        app_commands.Choice(name='名前の変更',value="nick"),
+        app_commands.Choice(name='ロール追加',value="role_add"),
+        app_commands.Choice(name='ロール削除',value="role_remove"),
+        app_commands.Choice(name='チャンネル作成',value="channel_create"),
+        app_commands.Choice(name='チャンネル削除',value="channel_delete"),
+        app_commands.Choice(name='ロール作成',value="role_create"),
+        app_commands.Choice(name='ロール削除(サーバー)',value="role_delete"),
+        app_commands.Choice(name='招待リンク作成',value="invite"),
+        app_commands.Choice(name='手動で送信したログ',value="custom")
     ])
-    async def logging_search(self, ctx: commands.Context, 内容: app_commands.Choice[str]):
+    async def logging_search(self, ctx: commands.Context, 内容: app_commands.Choice[str] = None, ユーザー: discord.User = None, チャンネル: discord.abc.GuildChannel = None, 日数: int = None, 検索: str = None):
         await ctx.defer()
-        channel = await self.get_logging_channel(ctx.guild)
-        if not channel:
-            return await ctx.reply(embed=discord.Embed(title="<:Error:1362271424227709028> チャンネルが見つかりませんでした。", color=discord.Color.red()))
-        async for c_l in channel.history(limit=100):
-            if not c_l.embeds:
-                continue
-            if 内容.value == "delete":
-                if c_l.embeds[0].title == "<:Minus:1367039494322262096> メッセージが削除されました":
-                    if not c_l.embeds[0].description:
-                        return await ctx.reply(embed=discord.Embed(title="このサーバーで最後に削除されたメッセージ", color=discord.Color.green()))
-                    return await ctx.reply(embed=discord.Embed(title="このサーバーで最後に削除されたメッセージ", description=c_l.embeds[0].description, color=discord.Color.green()).set_author(name=c_l.embeds[0].author.name, icon_url=c_l.embeds[0].author.icon_url))
-            elif 内容.value == "join":
-                if c_l.embeds[0].title == "<:Plus:1367039505865113670> メンバーが参加しました":
-                    if not c_l.embeds[0].description:
-                        return await ctx.reply(embed=discord.Embed(title="このサーバーで最後に参加したユーザー", color=discord.Color.green()))
-                    return await ctx.reply(embed=discord.Embed(title="このサーバーで最後に参加したユーザー", description=c_l.embeds[0].description, color=discord.Color.green()).set_author(name=c_l.embeds[0].author.name, icon_url=c_l.embeds[0].author.icon_url))
-        return await ctx.reply(embed=discord.Embed(title="見つかりませんでした。", color=discord.Color.red()))
+        query = {"Guild": ctx.guild.id}
+        if 内容:
+            query["Type"] = 内容.value
+        if ユーザー:
+            query["User"] = ユーザー.id
+        if チャンネル:
+            query["Channel"] = チャンネル.id
+        if 日数:
+            days = min(max(日数, 1), LOG_SEARCH_MAX_DAYS)
+            query["Time"] = {"$gte": datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)}
+        if 検索:
+            # 日本語は単語の区切りがなく$textでは語の途中に一致しないため、サーバー内を部分一致で探す
+            query["Text"] = {"$regex": re.escape(検索), "$options": "i"}
+        # 溜まっている分も検索に含める
+        await self.flush_events()
+        try:
+            total = await self.bot.async_db["Main"].EventLog.count_documents(query)
+            embed = await self.logsearch_embed(query, 0, total)
+        except Exception as e:
+            print(f"Error in logging_search: {e}")
+            return await ctx.reply(embed=discord.Embed(title="<:Error:1362271424227709028> ログを検索できませんでした。", color=discord.Color.red()))
+        pages = (total + LOG_SEARCH_PAGE_SIZE - 1) // LOG_SEARCH_PAGE_SIZE
+        return await ctx.reply(embed=embed, view=PagedView(ctx, 0, pages, lambda page: self.logsearch_embed(query, page, total)))
 
 async def setup(bot):
     await bot.add_cog(LoggingCog(bot))
\ No newline at end of file
@@ -1,29 +1,403 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 import random
 import string
 import io
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
 import json
 import os
-from datetime import timedelta
+import asyncio
+import time
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+from pymongo import UpdateOne
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from utils import percentile
 
 ROLE_FILE = "roles.json"
+CAPTCHA_WORKERS = 2          # 認証画像を描くプロセスの数
+CAPTCHA_READY_SIZE = 200     # 描いておく認証画像の数 (参加が集中したときはここから配る)
+CAPTCHA_SIZE = (220, 100)
+CAPTCHA_FONT = "arial.ttf"
+VERIFY_CODE_TTL = 600          # 認証コードの有効期限 (秒)
+VERIFY_CODE_MAX = 50000        # 覚えておく認証途中のユーザーの最大数
+VERIFY_SWEEP_INTERVAL = 60     # 期限切れの認証コードを掃除する間隔 (秒)
+VERIFY_PERSIST_CHALLENGES = True  # リロード・再起動の間も認証途中のコードをMongoに残す
+VERIFY_RAID_THRESHOLD = 30     # 1分間の認証の試行がこれを超えたらレイドモードにする
+VERIFY_RAID_DURATION = 600     # レイドモードを続ける秒数 (試行が続く間は延長する)
+VERIFY_REPLY_WAIT = 5          # ロール付与の完了を待ってから返信する最大秒数
+VERIFY_METRICS_SAMPLES = 2000  # 付与にかかった時間の統計に使う直近の件数
+VERIFY_TIMEOUT_MINUTES = 10    # 認証に失敗したときのタイムアウト
+VERIFY_FLUSH_TIMEOUT = 10      # 終了時に順番待ちのロール付与・タイムアウトを実行しきるまで待つ最大秒数
 
-def load_roles():
-    if os.path.exists(ROLE_FILE):
-        with open(ROLE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+# ===== 認証画像 (プロセスプールの中で動く) =====
+captcha_font = None
 
-def save_roles(data):
-    with open(ROLE_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def init_captcha_worker():
+    # フォントはプロセスごとに1回だけ読み込む。乱数はforkした親と同じにならないようにする
+    global captcha_font
+    random.seed()
+    try:
+        captcha_font = ImageFont.truetype(CAPTCHA_FONT, 40)
+    except:
+        captcha_font = ImageFont.load_default()
+
+def render_captcha(code: str):
+    if captcha_font is None:
+        init_captcha_worker()
+    width, height = CAPTCHA_SIZE
+    image = Image.new("RGB", CAPTCHA_SIZE, (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    draw.text((50, 30), code, font=captcha_font, fill=(0, 0, 0))
+    for _ in range(5):
+        draw.line(
+            [(random.randint(0, width), random.randint(0, height)),
+             (random.randint(0, width), random.randint(0, height))],
+            fill=(150, 150, 150), width=2
+        )
+    for _ in range(200):
+        x, y = random.randint(0, width - 1), random.randint(0, height - 1)
+        draw.point((x, y), fill=(random.randint(0, 255), 0, 0))
+    image = image.filter(ImageFilter.GaussianBlur(0.7))
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def new_captcha_code():
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
+
+class CaptchaFactory:
+    """認証画像をプロセスプールで先に描いておき、ボタンが押されたら描き終わったものを渡す"""
+    def __init__(self, workers: int = CAPTCHA_WORKERS, ready_size: int = CAPTCHA_READY_SIZE):
+        self.workers = workers
+        self.ready = asyncio.Queue(maxsize=ready_size)
+        self.executor = None
+        self.tasks = []
+        self.served = 0
+        self.on_demand = 0
+
+    def new_executor(self):
+        # forkだとBotのソケットやスレッドの状態まで子プロセスに引き継ぐので、spawnで起動する
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=init_captcha_worker, mp_context=multiprocessing.get_context("spawn"))
+
+    def start(self):
+        self.executor = self.new_executor()
+        self.tasks = [asyncio.create_task(self.refill()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def render(self, code: str):
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        try:
+            return await loop.run_in_executor(executor, render_captcha, code)
+        except BrokenProcessPool:
+            # プロセスが落ちた場合は作り直す。同じプールで失敗した他の呼び出しは作り直さない
+            if self.executor is executor:
+                print("認証画像のプロセスプールを作り直します。")
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self.new_executor()
+            raise
+
+    async def refill(self):
+        # キューが満杯の間は put で待つので、描きすぎることはない
+        while True:
+            try:
+                code = new_captcha_code()
+                image = await self.render(code)
+                await self.ready.put((code, image))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error in CaptchaFactory.refill: {e}")
+                await asyncio.sleep(5)
+
+    async def get(self):
+        self.served += 1
+        try:
+            return self.ready.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        # 描き置きがない場合もイベントループでは描かない
+        self.on_demand += 1
+        code = new_captcha_code()
+        try:
+            return code, await self.render(code)
+        except Exception:
+            return code, await asyncio.to_thread(render_captcha, code)
+
+    def stats(self):
+        return {
+            "ready": self.ready.qsize(),
+            "max_ready": self.ready.maxsize,
+            "served": self.served,
+            "on_demand": self.on_demand,
+        }
+
+def read_role_file():
+    # 以前のroles.json ({"guild_id": role_id}) を読む (移行のときだけ使う)
+    with open(ROLE_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+class PendingChallengeStore:
+    """認証途中のユーザーのコード。期限切れは取り出すときと定期的な掃除で消え、件数にも上限がある"""
+    def __init__(self, ttl: float = VERIFY_CODE_TTL, maxsize: int = VERIFY_CODE_MAX):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # user_id: (code, guild_id, role_id, 期限のUNIX時刻) 期限の早い順
+        self.expired = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, user_id: int, code: str, guild_id: int, role_id: int, expires: float = None):
+        self.entries.pop(user_id, None)
+        self.entries[user_id] = (code, guild_id, role_id, expires or time.time() + self.ttl)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, user_id: int):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[3] < time.time():
+            del self.entries[user_id]
+            self.expired += 1
+            return None
+        return entry[:3]
+
+    def pop(self, user_id: int, default=None):
+        entry = self.entries.pop(user_id, None)
+        if entry is None:
+            return default
+        return entry[:3]
+
+    def sweep(self):
+        # 有効期限はどれも同じ長さなので、古い順に見て期限内のものが出たら終わり
+        now = time.time()
+        while self.entries:
+            user_id, entry = next(iter(self.entries.items()))
+            if entry[3] >= now:
+                break
+            del self.entries[user_id]
+            self.expired += 1
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "maxsize": self.maxsize,
+            "expired": self.expired,
+            "evictions": self.evictions,
+        }
+
+class VerifyRoleStore:
+    """サーバーごとの認証ロール。メモリに全件持ち、変更はMongoに書いてから反映する"""
+    def __init__(self, bot):
+        self.bot = bot
+        self.roles = {}  # guild_id: role_id
+        self.loaded = False
+        self.loading = None
+
+    @property
+    def collection(self):
+        return self.bot.async_db["Main"].VerifyRole
+
+    async def load(self):
+        await self.migrate_role_file()
+        roles = {}
+        async for doc in self.collection.find({}, {"_id": False}):
+            roles[doc["Guild"]] = doc["Role"]
+        self.roles = roles
+        self.loaded = True
+        print(f"認証ロールを読み込みました: {len(self.roles)}")
+
+    async def ensure_loaded(self):
+        # 読み込みに失敗していた場合は次に使うときに読み込み直す (同時には1回だけ)
+        if self.loaded:
+            return True
+        if self.loading is None or self.loading.done():
+            self.loading = asyncio.ensure_future(self.load())
+        try:
+            await asyncio.shield(self.loading)
+        except Exception as e:
+            print(f"Error in VerifyRoleStore.load: {e}")
+        return self.loaded
+
+    async def migrate_role_file(self):
+        if not os.path.exists(ROLE_FILE):
+            return
+        data = await asyncio.to_thread(read_role_file)
+        # Mongoにすでにある設定は上書きしない
+        requests = [UpdateOne({"Guild": int(guild_id)}, {"$setOnInsert": {"Guild": int(guild_id), "Role": int(role_id)}}, upsert=True) for guild_id, role_id in data.items()]
+        if requests:
+            await self.collection.bulk_write(requests, ordered=False)
+        # 移行が終わったファイルは残しておくが、二度と読まないように名前を変える
+        os.replace(ROLE_FILE, ROLE_FILE + ".migrated")
+        print(f"{ROLE_FILE} の認証ロールを移行しました: {len(requests)}")
+
+    def get(self, guild_id: int):
+        return self.roles.get(guild_id)
+
+    async def set(self, guild_id: int, role_id: int):
+        await self.collection.update_one({"Guild": guild_id}, {"$set": {"Role": role_id}}, upsert=True)
+        self.roles[guild_id] = role_id
+
+class GuildVerifyQueue:
+    """サーバー1つ分のロール付与・タイムアウト待ち"""
+    def __init__(self):
+        self.grants = deque()    # (member, role, future, 追加した時刻)
+        self.timeouts = deque()  # (member, 解除時刻, future, 追加した時刻)
+        self.attempts = deque()  # 直近1分の認証の試行時刻
+        self.raid_until = 0.0
+        self.worker = None
+
+    def __len__(self):
+        return len(self.grants) + len(self.timeouts)
+
+    def raid(self, now: float):
+        return now < self.raid_until
+
+class VerifyPipeline:
+    """認証後のロール付与とタイムアウトをサーバーごとに順番に実行する。送る速さは discord.py のレート制限に任せる。
+    試行が急増したサーバーは自動でレイドモードになり、ロール付与を先にしてタイムアウトは後回しにする"""
+    def __init__(self):
+        self.queues = {}  # guild_id: GuildVerifyQueue
+        self.latencies = deque(maxlen=VERIFY_METRICS_SAMPLES)
+        self.stats_counter = Counter()
+
+    def queue(self, guild_id: int):
+        queue = self.queues.get(guild_id)
+        if queue is None:
+            queue = self.queues[guild_id] = GuildVerifyQueue()
+        return queue
+
+    def record_attempt(self, guild_id: int):
+        queue = self.queue(guild_id)
+        now = time.monotonic()
+        queue.attempts.append(now)
+        while queue.attempts and queue.attempts[0] < now - 60:
+            queue.attempts.popleft()
+        if len(queue.attempts) > VERIFY_RAID_THRESHOLD:
+            if not queue.raid(now):
+                print(f"認証の試行が急増したためレイドモードにします: guild={guild_id}")
+                self.stats_counter["raids"] += 1
+            queue.raid_until = now + VERIFY_RAID_DURATION
+        self.cleanup(guild_id, queue)
+
+    def submit_grant(self, member: discord.Member, role: discord.Role):
+        return self.submit(member.guild.id, "grant", member, role)
+
+    def submit_timeout(self, member: discord.Member, until):
+        return self.submit(member.guild.id, "timeout", member, until)
+
+    def submit(self, guild_id: int, kind: str, member: discord.Member, arg):
+        queue = self.queue(guild_id)
+        future = asyncio.get_running_loop().create_future()
+        job = (member, arg, future, time.monotonic())
+        (queue.grants if kind == "grant" else queue.timeouts).append(job)
+        if queue.worker is None or queue.worker.done():
+            queue.worker = asyncio.create_task(self.run(guild_id, queue))
+        return future
+
+    async def run(self, guild_id: int, queue: GuildVerifyQueue):
+        while queue:
+            # レイドモード中はタイムアウトよりロール付与を先にする
+            now = time.monotonic()
+            if queue.grants and (queue.raid(now) or not queue.timeouts or queue.grants[0][3] <= queue.timeouts[0][3]):
+                kind, (member, arg, future, queued_at) = "grant", queue.grants.popleft()
+            else:
+                kind, (member, arg, future, queued_at) = "timeout", queue.timeouts.popleft()
+            result = False
+            try:
+                if kind == "grant":
+                    await member.add_roles(arg, reason="認証")
+                    self.latencies.append(time.monotonic() - queued_at)
+                    self.stats_counter["granted"] += 1
+                else:
+                    await member.timeout(arg, reason="認証失敗")
+                    self.stats_counter["timed_out"] += 1
+                result = True
+            except asyncio.CancelledError:
+                # 実行中に止められた分も待っている側に失敗として返す
+                if not future.done():
+                    future.set_result(False)
+                raise
+            except discord.Forbidden:
+                self.stats_counter["failed"] += 1
+            except discord.HTTPException as e:
+                self.stats_counter["failed"] += 1
+                print(f"Error in VerifyPipeline: {e}")
+            except Exception as e:
+                self.stats_counter["failed"] += 1
+                print(f"Error in VerifyPipeline: {e}")
+            if not future.done():
+                future.set_result(result)
+        queue.worker = None
+        self.cleanup(guild_id, queue)
+
+    def cleanup(self, guild_id: int, queue: GuildVerifyQueue):
+        # 待ちも試行の記録もないサーバーは覚えておかない
+        if not queue and not queue.attempts and not queue.raid(time.monotonic()) and (queue.worker is None or queue.worker.done()):
+            if self.queues.get(guild_id) is queue:
+                del self.queues[guild_id]
+
+    def sweep(self):
+        cutoff = time.monotonic() - 60
+        for guild_id, queue in list(self.queues.items()):
+            while queue.attempts and queue.attempts[0] < cutoff:
+                queue.attempts.popleft()
+            self.cleanup(guild_id, queue)
+
+    async def drain(self, timeout: float = VERIFY_FLUSH_TIMEOUT):
+        workers = [queue.worker for queue in self.queues.values() if queue.worker and not queue.worker.done()]
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+
+    def stop(self):
+        dropped = 0
+        for queue in self.queues.values():
+            if queue.worker:
+                queue.worker.cancel()
+            # 待ち切れなかった分は失敗として返し、待っている側を止めない
+            for member, arg, future, queued_at in list(queue.grants) + list(queue.timeouts):
+                dropped += 1
+                if not future.done():
+                    future.set_result(False)
+            queue.grants.clear()
+            queue.timeouts.clear()
+        if dropped:
+            print(f"終了までに実行できなかった認証の処理: {dropped}件")
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "queued": sum(len(queue) for queue in self.queues.values()),
+            "max_guild_queue": max((len(queue) for queue in self.queues.values()), default=0),
+            "raid_guilds": sum(1 for queue in self.queues.values() if queue.raid(now)),
+            "raids": self.stats_counter["raids"],
+            "granted": self.stats_counter["granted"],
+            "timed_out": self.stats_counter["timed_out"],
+            "failed": self.stats_counter["failed"],
+            "grant_p50_ms": round(percentile(self.latencies, 50) * 1000, 1),
+            "grant_p99_ms": round(percentile(self.latencies, 99) * 1000, 1),
+        }
+
+def get_verify_cog(interaction: discord.Interaction):
+    # 再読み込み後も古いCogを掴まないよう、押されたときに今のCogを探す
+    return interaction.client.get_cog("VerifyCog")
 
 class CodeModal(discord.ui.Modal, title="認証コードの入力"):
-    def __init__(self, cog, user):
+    def __init__(self, user):
         super().__init__()
-        self.cog = cog
         self.user = user
         self.add_item(discord.ui.TextInput(
             label="認証コードを入力",
@@ -33,7 +407,8 @@ class CodeModal(discord.ui.Modal, title="認証コードの入力"):
 
     async def on_submit(self, interaction: discord.Interaction):
         input_code = self.children[0].value.strip().upper()
-        verify_info = self.cog.verify_codes.get(self.user.id)
+        cog = get_verify_cog(interaction)
+        verify_info = cog.verify_codes.get(self.user.id) if cog else None
 
         if verify_info is None:
             await interaction.response.send_message(
@@ -43,31 +418,41 @@ class CodeModal(discord.ui.Modal, title="認証コードの入力"):
             return
 
         code, guild_id, role_id = verify_info
-        guild = self.cog.bot.get_guild(int(guild_id))
-        member = guild.get_member(self.user.id)
+        guild = cog.bot.get_guild(int(guild_id))
+        member = guild.get_member(self.user.id) if guild else None
+        pipeline = cog.pipeline
+        pipeline.record_attempt(int(guild_id))
 
         if input_code == code:
-            if guild and member:
-                role = guild.get_role(role_id)
-                if role:
-                    await member.add_roles(role)
-                    self.cog.verify_codes.pop(self.user.id, None)
-                    await interaction.response.send_message(f"<:check:1394240622310850580>認証しました。", ephemeral=True)
-                    return
-
-            await interaction.response.send_message("<:warn:1394241229176311888> サーバーまたはロール情報に問題があります。", ephemeral=True)
+            role = guild.get_role(role_id) if guild and member else None
+            if role is None:
+                await interaction.response.send_message("<:warn:1394241229176311888> サーバーまたはロール情報に問題があります。", ephemeral=True)
+                return
+            cog.verify_codes.pop(self.user.id, None)
+            # ロールの付与は順番待ちになるので、少しだけ待ってから結果を返す
+            await interaction.response.defer(ephemeral=True, thinking=True)
+            future = pipeline.submit_grant(member, role)
+            done, _ = await asyncio.wait([future], timeout=VERIFY_REPLY_WAIT)
+            if not done:
+                await interaction.followup.send(f"<:check:1394240622310850580>認証しました。混雑しているため、ロールはまもなく付与されます。", ephemeral=True)
+            elif future.result():
+                await interaction.followup.send(f"<:check:1394240622310850580>認証しました。", ephemeral=True)
+            else:
+                await interaction.followup.send("<:warn:1394241229176311888> ロールを付与できませんでした。管理者に連絡してください。", ephemeral=True)
         else:
-            # 認証失敗 → タイムアウト処理（1分）
+            # 認証失敗 → タイムアウト処理（10分）
             if member:
-                try:
-                    await member.timeout(discord.utils.utcnow() + timedelta(minutes=10), reason="認証失敗")
-                    await interaction.response.send_message(
-                        f"<:cross:1394240624202481705>認証に失敗しました。\n1分後にやり直してください。",
+                await interaction.response.defer(ephemeral=True, thinking=True)
+                future = pipeline.submit_timeout(member, discord.utils.utcnow() + timedelta(minutes=VERIFY_TIMEOUT_MINUTES))
+                done, _ = await asyncio.wait([future], timeout=VERIFY_REPLY_WAIT)
+                if done and not future.result():
+                    await interaction.followup.send(
+                        f"<:cross:1394240624202481705>認証に失敗しました。",
                         ephemeral=True
                     )
-                except discord.Forbidden:
-                    await interaction.response.send_message(
-                        f"<:cross:1394240624202481705>認証に失敗しました。",
+                else:
+                    await interaction.followup.send(
+                        f"<:cross:1394240624202481705>認証に失敗しました。\n{VERIFY_TIMEOUT_MINUTES}分後にやり直してください。",
                         ephemeral=True
                     )
             else:
@@ -77,28 +462,29 @@ class CodeModal(discord.ui.Modal, title="認証コードの入力"):
                 )
 
 class CodeInputButton(discord.ui.Button):
-    def __init__(self, cog, user):
-        super().__init__(label="コードを入力", style=discord.ButtonStyle.success)
-        self.cog = cog
-        self.user = user
+    # 認証コードはユーザーごとに保存しているので、押した人のコードで確認する
+    def __init__(self):
+        super().__init__(label="コードを入力", style=discord.ButtonStyle.success, custom_id="verify_v1+code")
 
     async def callback(self, interaction: discord.Interaction):
-        if interaction.user.id != self.user.id:
-            await interaction.response.send_message(f"<:cross:1394240624202481705>このボタンはあなた専用です。", ephemeral=True)
-            return
-        await interaction.response.send_modal(CodeModal(self.cog, self.user))
+        await interaction.response.send_modal(CodeModal(interaction.user))
 
 class VerifyStartButton(discord.ui.Button):
-    def __init__(self, cog):
-        super().__init__(label="認証", style=discord.ButtonStyle.primary)
-        self.cog = cog
+    def __init__(self):
+        super().__init__(label="認証", style=discord.ButtonStyle.primary, custom_id="verify_v1+start")
 
     async def callback(self, interaction: discord.Interaction):
         user = interaction.user
         guild = interaction.guild
-        guild_id = str(guild.id)
-        roles = load_roles()
-        role_id = roles.get(guild_id)
+        cog = get_verify_cog(interaction)
+        if cog is None:
+            await interaction.response.send_message(
+                f"<:warn:1394241229176311888>現在認証を利用できません。しばらくしてからやり直してください。",
+                ephemeral=True
+            )
+            return
+        await cog.role_store.ensure_loaded()
+        role_id = cog.role_store.get(guild.id)
 
         if role_id is None:
             await interaction.response.send_message(
@@ -115,37 +501,14 @@ class VerifyStartButton(discord.ui.Button):
             )
             return
 
-        # 認証コード生成
-        code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
-
-        # 画像作成
-        image = Image.new("RGB", (220, 100), (255, 255, 255))
-        draw = ImageDraw.Draw(image)
-        try:
-            font = ImageFont.truetype("arial.ttf", 40)
-        except:
-            font = ImageFont.load_default()
-        draw.text((50, 30), code, font=font, fill=(0, 0, 0))
-        for _ in range(5):
-            draw.line(
-                [(random.randint(0, 220), random.randint(0, 100)),
-                 (random.randint(0, 220), random.randint(0, 100))],
-                fill=(150, 150, 150), width=2
-            )
-        for _ in range(200):
-            x, y = random.randint(0, 219), random.randint(0, 99)
-            draw.point((x, y), fill=(random.randint(0, 255), 0, 0))
-        image = image.filter(ImageFilter.GaussianBlur(0.7))
-
-        buffer = io.BytesIO()
-        image.save(buffer, format="PNG")
-        buffer.seek(0)
+        # 認証コードと画像は描き置きから取り出す
+        code, image = await cog.captcha_factory.get()
+        buffer = io.BytesIO(image)
 
-        self.cog.verify_codes[user.id] = (code, guild.id, role_id)
+        cog.verify_codes.put(user.id, code, guild.id, role_id)
 
         # コード入力ボタン
-        view = discord.ui.View()
-        view.add_item(CodeInputButton(self.cog, user))
+        view = CodeInputView()
 
         file = discord.File(buffer, filename="captcha.png")
         await interaction.response.send_message(
@@ -155,22 +518,107 @@ class VerifyStartButton(discord.ui.Button):
             ephemeral=True
         )
 
+class VerifyStartView(discord.ui.View):
+    # 再起動後も押せるように custom_id を固定し、cog_load で登録する
+    def __init__(self):
+        super().__init__(timeout=None)
+        self.add_item(VerifyStartButton())
+
+class CodeInputView(discord.ui.View):
+    def __init__(self):
+        super().__init__(timeout=None)
+        self.add_item(CodeInputButton())
+
 class VerifyCog(commands.Cog):
+    mongo_indexes = {
+        "VerifyRole": [([("Guild", 1)], {"unique": True})],
+        "VerifyChallenge": [([("Expires", 1)], {"expireAfterSeconds": 0})],
+    }
+    mongo_queries = {
+        "VerifyRole": [("Guild",)],
+        "VerifyChallenge": [("Expires",)],
+    }
+
     def __init__(self, bot):
         self.bot = bot
-        self.verify_codes = {}  # user_id: (code, guild_id, role_id)
+        self.role_store = VerifyRoleStore(bot)
+        self.verify_codes = PendingChallengeStore()  # user_id: (code, guild_id, role_id)
+        self.captcha_factory = CaptchaFactory()
+        self.pipeline = VerifyPipeline()
+
+    async def cog_load(self):
+        self.captcha_factory.start()
+        self.bot.add_view(VerifyStartView())
+        self.bot.add_view(CodeInputView())
+        await self.role_store.ensure_loaded()
+        if VERIFY_PERSIST_CHALLENGES:
+            await self.load_challenges()
+        self.sweep_challenges.start()
+
+    async def cog_unload(self):
+        self.sweep_challenges.cancel()
+        await self.flush_pending()
+        self.captcha_factory.stop()
+        self.pipeline.stop()
+        if VERIFY_PERSIST_CHALLENGES:
+            await self.save_challenges()
+
+    async def flush_pending(self):
+        # 認証済みと伝えたユーザーのロール付与を取りこぼさないよう、順番待ちを実行しきる
+        await self.pipeline.drain()
+
+    @tasks.loop(seconds=VERIFY_SWEEP_INTERVAL)
+    async def sweep_challenges(self):
+        self.verify_codes.sweep()
+        self.pipeline.sweep()
+
+    async def load_challenges(self):
+        # 前回のアンロード時に保存した認証途中のコードを戻す (期限切れはTTLインデックスでも消える)
+        db = self.bot.async_db["Main"].VerifyChallenge
+        try:
+            now = datetime.now(timezone.utc)
+            async for doc in db.find({"Expires": {"$gt": now}}, {"_id": False}).sort("Expires", 1):
+                expires = doc["Expires"]
+                if expires.tzinfo is None:
+                    expires = expires.replace(tzinfo=timezone.utc)
+                self.verify_codes.put(doc["User"], doc["Code"], doc["Guild"], doc["Role"], expires.timestamp())
+            await db.delete_many({})
+        except Exception as e:
+            print(f"Error in load_challenges: {e}")
+
+    async def save_challenges(self):
+        db = self.bot.async_db["Main"].VerifyChallenge
+        self.verify_codes.sweep()
+        docs = [
+            {"User": user_id, "Code": code, "Guild": guild_id, "Role": role_id, "Expires": datetime.fromtimestamp(expires, timezone.utc)}
+            for user_id, (code, guild_id, role_id, expires) in self.verify_codes.entries.items()
+        ]
+        try:
+            await db.delete_many({})
+            if docs:
+                await db.insert_many(docs, ordered=False)
+        except Exception as e:
+            print(f"Error in save_challenges: {e}")
+
+    def cache_stats(self):
+        return {
+            "verify_captcha": self.captcha_factory.stats(),
+            "verify_challenges": self.verify_codes.stats(),
+            "verify_pipeline": self.pipeline.stats(),
+            "verify_roles": {"loaded": self.role_store.loaded, "guilds": len(self.role_store.roles)},
+        }
 
     @commands.hybrid_command(name="verify", with_app_command=True, description="認証ロール設定または認証パネル送信")
     @commands.has_permissions(administrator=True)
     async def verify(self, ctx: commands.Context, role: discord.Role = None):
-        roles = load_roles()
-        guild_id = str(ctx.guild.id)
+        if not await self.role_store.ensure_loaded():
+            await ctx.send(f"<:warn:1394241229176311888> 認証ロールを読み込めませんでした。しばらくしてからやり直してください。", ephemeral=True)
+            return
         if role is not None:
-            roles[guild_id] = role.id
-            save_roles(roles)
+            await self.role_store.set(ctx.guild.id, role.id)
             await ctx.send(f"<:check:1394240622310850580>認証ロールを `{role.name}` に設定しました。", ephemeral=True)
         else:
-            role_id = roles.get(guild_id)
+            role_id = self.role_store.get(ctx.guild.id)
             if role_id is None:
                 await ctx.send(f"<:warn:1394241229176311888> 認証ロールが設定されていません。`/verify @ロール名` で設定してください。", ephemeral=True)
                 return
@@ -178,9 +626,7 @@ class VerifyCog(commands.Cog):
                 description=f"<@&{role_id}>をもらうには認証してください。",
                 color=discord.Color.green()
             )
-            view = discord.ui.View()
-            view.add_item(VerifyStartButton(self))  # Cogを渡す
-            await ctx.send(embed=embed, view=view)
+            await ctx.send(embed=embed, view=VerifyStartView())
     @verify.error
     async def verify_error(self, ctx, error):
         if isinstance(error, commands.MissingPermissions):
@@ -0,0 +1,40 @@
+# レベルデータのインポート・エクスポート用のコマンドラインツール
+# 例:
+#   python leveltool.py export 123456789012345678 leveling.jsonl.gz
+#   python leveltool.py import 123456789012345678 mee6.csv
+import argparse
+import asyncio
+import sys
+import time
+import motor.motor_asyncio
+from cogs.level import export_leveling, import_leveling, level_transfer_format
+
+async def run(args):
+    client = motor.motor_asyncio.AsyncIOMotorClient(args.mongo)
+    collection = client[args.database].Leveling
+    fmt, compressed = level_transfer_format(args.file)
+    start = time.perf_counter()
+    if args.command == "export":
+        with open(args.file, "wb") as fp:
+            count = await export_leveling(collection, args.guild, fp, fmt, compressed)
+    else:
+        with open(args.file, "rb") as fp:
+            count = await import_leveling(collection, args.guild, fp, fmt, compressed)
+    print(f"{args.command}: {count}件 ({time.perf_counter() - start:.2f}秒)")
+    client.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="レベルデータをJSONL/CSV(.gz)で読み書きします。")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("guild", type=int, help="サーバーID")
+    parser.add_argument("file", help="ファイル名 (.jsonl / .csv、末尾に .gz で圧縮)")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017/", help="MongoDBの接続文字列")
+    parser.add_argument("--database", default="Main", help="データベース名")
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,10 @@ import os
 import json
 import sys
 import subprocess
+import asyncio
+import time
+import aiohttp
+from collections import OrderedDict
 import motor.motor_asyncio # motorのインポートを追加
 
 # ===== 許可するユーザーID =====
@@ -11,6 +15,43 @@ ALLOWED_USER_IDS = [
     1262439270488997991, 1012652131003682837, 1195288310189404251
 ]
 
+# ===== HTTP接続プールの設定 =====
+HTTP_POOL_LIMIT = 100            # 同時接続数の上限
+HTTP_KEEPALIVE_TIMEOUT = 60      # 使っていない接続を保持する秒数
+WEBHOOK_CACHE_SIZE = 5000        # URLごとに保持するWebhookの数
+WEBHOOK_RATE_LIMIT = 5           # Webhookごとに WEBHOOK_RATE_PER 秒あたり送れる回数
+WEBHOOK_RATE_PER = 2
+
+# ===== Webhookのレート制限 =====
+class WebhookBucket:
+    """Webhook 1つ分のレート制限。acquire() で送信枠が空くまで待つ"""
+    def __init__(self, limit: int = WEBHOOK_RATE_LIMIT, per: float = WEBHOOK_RATE_PER):
+        self.limit = limit
+        self.per = per
+        self.remaining = limit
+        self.reset_at = 0.0
+        self.lock = asyncio.Lock()
+        self.waited = 0.0  # 枠待ちで待った合計秒数
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            if now >= self.reset_at:
+                self.remaining = self.limit
+                self.reset_at = now + self.per
+            if self.remaining <= 0:
+                delay = self.reset_at - now
+                self.waited += delay
+                await asyncio.sleep(delay)
+                self.remaining = self.limit
+                self.reset_at = time.monotonic() + self.per
+            self.remaining -= 1
+
+    def limited(self, retry_after: float):
+        # 429を受けたときは指定された時間まで枠を空にする
+        self.remaining = 0
+        self.reset_at = time.monotonic() + retry_after
+
 # ===== コマンド制限デコレータ =====
 def is_owner_user():
     async def predicate(ctx):
@@ -30,9 +71,19 @@ class MyBot(commands.Bot):
 
         self.async_db = None # MongoDBクライアント
         self.main_db = None  # 特定のデータベースインスタンス (例: "Main")
+        self.index_task = None
+        self.http_session = None # ボット全体で共有するaiohttpのセッション
+        self.webhooks = OrderedDict() # URL: Webhook
+        self.webhook_buckets = OrderedDict() # URL: WebhookBucket
 
     # ボットがDiscordに接続する準備ができたときに呼び出される
     async def setup_hook(self):
+        # Webhookの送信や画像のダウンロードはこのセッションの接続を使い回す
+        self.http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT),
+            timeout=aiohttp.ClientTimeout(total=30)
+        )
+
         # ここでMongoDBに接続します
         try:
             # ご自身のMongoDB接続文字列に置き換えてください
@@ -57,6 +108,88 @@ class MyBot(commands.Bot):
 
         print('Cogsのロードが完了しました。')
 
+        # インデックスの作成は起動を止めないようにバックグラウンドで行う
+        self.index_task = asyncio.create_task(self.ensure_indexes())
+
+    # 各Cogの mongo_indexes / mongo_queries を集めたインデックスの一覧
+    # mongo_indexes = {"コレクション": [([("キー", 1), ...], {オプション}), ...]}
+    # mongo_queries = {"コレクション": [("検索・ソートに使うキー", ...), ...]}
+    def index_manifest(self):
+        indexes = {}
+        queries = {}
+        for cog in self.cogs.values():
+            for collection, specs in getattr(cog, "mongo_indexes", {}).items():
+                for keys, options in specs:
+                    if (keys, options) not in indexes.setdefault(collection, []):
+                        indexes[collection].append((keys, options))
+            for collection, shapes in getattr(cog, "mongo_queries", {}).items():
+                for shape in shapes:
+                    queries.setdefault(collection, set()).add(tuple(shape))
+        return indexes, queries
+
+    async def ensure_indexes(self):
+        if self.async_db is None:
+            return
+        db = self.async_db["Main"]
+        indexes, queries = self.index_manifest()
+        for collection, specs in indexes.items():
+            for keys, options in specs:
+                try:
+                    await db[collection].create_index(keys, background=True, **options)
+                except Exception as e:
+                    print(f"インデックスの作成に失敗しました {collection} {keys}: {e}")
+        # インデックスで賄えない検索を報告する
+        for collection, shapes in queries.items():
+            prefixes = [[k for k, _ in keys] for keys, _ in indexes.get(collection, [])]
+            for shape in sorted(shapes):
+                if any(set(prefix[:len(shape)]) == set(shape) for prefix in prefixes):
+                    continue
+                if any(prefix[0] in shape for prefix in prefixes):
+                    print(f"インデックスで一部しか絞り込めない検索: {collection} {shape}")
+                else:
+                    print(f"インデックスがない検索: {collection} {shape}")
+        print("インデックスの確認が完了しました。")
+
+    # URLごとにWebhookを使い回す (共有セッションに紐づける)
+    def get_webhook(self, url: str):
+        webhook = self.webhooks.get(url)
+        if webhook is None:
+            webhook = discord.Webhook.from_url(url, session=self.http_session)
+            self.webhooks[url] = webhook
+            if len(self.webhooks) > WEBHOOK_CACHE_SIZE:
+                self.webhooks.popitem(last=False)
+        else:
+            self.webhooks.move_to_end(url)
+        return webhook
+
+    # URLごとのレート制限 (送信する側が acquire() してから送る)
+    def webhook_bucket(self, url: str):
+        bucket = self.webhook_buckets.get(url)
+        if bucket is None:
+            bucket = self.webhook_buckets[url] = WebhookBucket()
+            if len(self.webhook_buckets) > WEBHOOK_CACHE_SIZE:
+                self.webhook_buckets.popitem(last=False)
+        else:
+            self.webhook_buckets.move_to_end(url)
+        return bucket
+
+    async def close(self):
+        # Cogのアンロード(書き込み)が終わってからセッションを閉じる
+        await super().close()
+        if self.http_session:
+            await self.http_session.close()
+
+    # 書き込み待ちのデータを持つCogをすべてDBに書き出す (flush_pendingを持つCogが対象)
+    async def flush_cogs(self):
+        for cog in list(self.cogs.values()):
+            flush = getattr(cog, "flush_pending", None)
+            if flush is None:
+                continue
+            try:
+                await flush()
+            except Exception as e:
+                print(f"Failed to flush {cog.qualified_name}: {e}")
+
     # ボットが完全に起動し、Discordにログインしたときに呼び出される
     @commands.Cog.listener() # setup_hook() は @bot.event ではなく、このクラス内で定義されるため @commands.Cog.listener() が適切
     async def on_ready(self):
@@ -71,6 +204,7 @@ bot = MyBot()
 async def load_cog(ctx, cog: str):
     try:
         await bot.load_extension(f"cogs.{cog}")
+        await bot.ensure_indexes()
         await ctx.send(f"Successfully loaded {cog}!")
     except Exception as e:
         await ctx.send(f"Error while loading `{cog}`: `{e}`")
@@ -80,6 +214,7 @@ async def load_cog(ctx, cog: str):
 async def reload_cog(ctx, cog: str):
     try:
         await bot.reload_extension(f"cogs.{cog}")
+        await bot.ensure_indexes()
         await ctx.send(f"Successfully reloaded {cog}!")
     except Exception as e:
         await ctx.send(f"Error while reloading `{cog}`: `{e}`")
@@ -103,16 +238,33 @@ async def list_cogs(ctx):
         cog_list = "\n".join(f"- {cog}" for cog in loaded)
         await ctx.send(f"Cogs currently loading:\n```\n{cog_list}\n```")
 
+@bot.command(name="cachestats")
+@is_owner_user()
+async def cache_stats(ctx):
+    lines = []
+    for cog in bot.cogs.values():
+        stats = getattr(cog, "cache_stats", None)
+        if stats is None:
+            continue
+        for name, values in stats().items():
+            lines.append(f"{name}: " + ", ".join(f"{k}={v}" for k, v in values.items()))
+    if not lines:
+        await ctx.send("No caches are currently loaded.")
+    else:
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
 @bot.command(name="shutdown")
 @is_owner_user()
 async def shutdown_bot(ctx):
     await ctx.send("Shutting down...")
+    await bot.flush_cogs()
     await bot.close()
 
 @bot.command(name="restart")
 @is_owner_user()
 async def restart_bot(ctx):
     await ctx.send("Restarting bot...")
+    await bot.flush_cogs()
     await bot.close()
     subprocess.Popen([sys.executable] + sys.argv)
     return
@@ -122,6 +274,7 @@ async def restart_bot(ctx):
 @reload_cog.error
 @unload_cog.error
 @list_cogs.error
+@cache_stats.error
 async def cog_permission_error(ctx, error):
     if isinstance(error, commands.CheckFailure):
         await ctx.send("⚠️You don't have permission to execute this command!")
@@ -130,20 +283,22 @@ async def cog_permission_error(ctx, error):
 
 # ===== Bot起動 =====
 # TOKENの読み込みはconfig.jsonから一箇所で行う
-try:
-    with open('config.json') as f:
-        config = json.load(f)
-        TOKEN = config.get("token") # .get() を使うとキーがない場合でもエラーにならない
-        if not TOKEN:
-            raise ValueError("Token not found in config.json")
-except FileNotFoundError:
-    print("エラー: config.jsonが見つかりません。")
-    sys.exit(1) # プログラムを終了
-except json.JSONDecodeError:
-    print("エラー: config.jsonの形式が不正です。")
-    sys.exit(1)
-except ValueError as e:
-    print(f"エラー: {e}")
-    sys.exit(1)
-
-bot.run(TOKEN)
\ No newline at end of file
+# (認証画像のプロセスプールがこのファイルを読み込んでもBotが起動しないようにする)
+if __name__ == "__main__":
+    try:
+        with open('config.json') as f:
+            config = json.load(f)
+            TOKEN = config.get("token") # .get() を使うとキーがない場合でもエラーにならない
+            if not TOKEN:
+                raise ValueError("Token not found in config.json")
+    except FileNotFoundError:
+        print("エラー: config.jsonが見つかりません。")
+        sys.exit(1) # プログラムを終了
+    except json.JSONDecodeError:
+        print("エラー: config.jsonの形式が不正です。")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"エラー: {e}")
+        sys.exit(1)
+
+    bot.run(TOKEN)
\ No newline at end of file
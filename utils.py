@@ -0,0 +1,117 @@
+"""複数のCogで使う小さな部品 (cogs/ の外に置くのは、cogs/*.py がすべて拡張として読み込まれるため)"""
+import asyncio
+import time
+from collections import OrderedDict
+
+import discord
+from discord.ext import commands
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class GuildCache:
+    """サーバーごとの設定をLRUで保持するキャッシュ。ttlを渡すとその秒数で読み直す"""
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # guild_id: (期限, 値)
+        self.loading = {}  # guild_id: 読み込み中のTask
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, guild_id: int):
+        entry = self.data.get(guild_id)
+        if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+            self.misses += 1
+            return None
+        self.data.move_to_end(guild_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, guild_id: int, value, epoch: int):
+        # 読み込み中に無効化された場合は古い値なので入れない
+        if epoch != self.epoch:
+            return
+        self.data[guild_id] = (time.monotonic() + self.ttl if self.ttl else None, value)
+        self.data.move_to_end(guild_id)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_load(self, guild_id: int, loader):
+        """キャッシュになければ loader() で読み込む。同じサーバーの読み込みは同時に1回だけ"""
+        value = self.get(guild_id)
+        if value is not None:
+            return value
+        task = self.loading.get(guild_id)
+        if task is not None:
+            return await asyncio.shield(task)
+        epoch = self.epoch
+        task = self.loading[guild_id] = asyncio.ensure_future(loader())
+        try:
+            value = await asyncio.shield(task)
+        finally:
+            self.loading.pop(guild_id, None)
+        self.put(guild_id, value, epoch)
+        return value
+
+    def invalidate(self, guild_id: int = None):
+        self.epoch += 1
+        if guild_id is None:
+            self.data.clear()
+        else:
+            self.data.pop(guild_id, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class PagedView(discord.ui.View):
+    """前へ・次へボタンでページを切り替えるView。render(page) でそのページの埋め込みを作る"""
+    def __init__(self, ctx: commands.Context, page: int, pages: int, render):
+        super().__init__(timeout=120)
+        self.ctx = ctx
+        self.page = page
+        self.pages = max(pages, 1)
+        self.render = render
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.prev_page.disabled = self.page <= 0
+        self.next_page.disabled = self.page >= self.pages - 1
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        if interaction.user.id != self.ctx.author.id:
+            await interaction.response.send_message("このボタンはコマンドを実行した人専用です。", ephemeral=True)
+            return False
+        return True
+
+    async def show(self, interaction: discord.Interaction):
+        self.update_buttons()
+        embed = await self.render(self.page)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(label="前へ", style=discord.ButtonStyle.secondary)
+    async def prev_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page = max(self.page - 1, 0)
+        await self.show(interaction)
+
+    @discord.ui.button(label="次へ", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page = min(self.page + 1, self.pages - 1)
+        await self.show(interaction)